@@ -1,12 +1,14 @@
+import datetime
 import dropq
 import os
-from ..taxbrain.helpers import package_up_vars, arrange_totals_by_row 
+from collections import Counter
+from ..taxbrain.helpers import package_up_arrays, arrange_totals_by_row
 import json
-import requests
 from requests.exceptions import Timeout, RequestException
 import requests_mock
-from ..taxbrain.compute import DropqCompute, MockCompute
-from .helpers import increment_ogusa_worker_idx, get_ogusa_worker_idx, filter_ogusa_only
+from ..taxbrain.compute import (DropqCompute, MockCompute, HOST_HEALTH,
+                                HostAllocator)
+from .helpers import filter_ogusa_only, normalize
 
 dqversion_info = dropq._version.get_versions()
 dropq_version = ".".join([dqversion_info['version'], dqversion_info['full'][:6]])
@@ -16,7 +18,7 @@ START_YEAR = int(os.environ.get('START_YEAR', 2016))
 dropq_workers = os.environ.get('DROPQ_WORKERS', '')
 DROPQ_WORKERS = dropq_workers.split(",")
 ENFORCE_REMOTE_VERSION_CHECK = os.environ.get('ENFORCE_VERSION', 'False') == 'True'
-TIMEOUT_IN_SECONDS = 1.0
+TIMEOUT_IN_SECONDS = float(os.environ.get('SUBMIT_TIMEOUT', 1.0))
 MAX_ATTEMPTS_SUBMIT_JOB = 20
 TAXCALC_RESULTS_TOTAL_ROW_KEYS = dropq.dropq.total_row_names
 ELASTIC_RESULTS_TOTAL_ROW_KEYS = ["gdp_elasticity"]
@@ -24,22 +26,62 @@ ogusa_workers = os.environ.get('OGUSA_WORKERS', '')
 OGUSA_WORKERS = ogusa_workers.split(",")
 CALLBACK_HOSTNAME = os.environ.get('CALLBACK_HOSTNAME', 'localhost:8000')
 ENFORCE_REMOTE_VERSION_CHECK = os.environ.get('ENFORCE_VERSION', 'False') == 'True'
+# OG-USA jobs submitted longer ago than this are taken to be lost, and no
+# longer count towards the jobs their host holds
+OGUSA_JOB_MAX_AGE_IN_HOURS = float(os.environ.get('OGUSA_JOB_MAX_AGE', 48))
+# The counter of the round robin over OGUSA_WORKERS
+OGUSA_ALLOCATOR = HostAllocator(2)
+
+
+def ogusa_jobs_held():
+    '''
+    The number of OG-USA jobs each host holds, counted from the runs of
+    every web process that were submitted and have no results yet
+    '''
+    from .models import DynamicSaveInputs
+    cutoff = (datetime.datetime.now() -
+              datetime.timedelta(hours=OGUSA_JOB_MAX_AGE_IN_HOURS))
+    runs = (DynamicSaveInputs.objects
+            .filter(tax_result__isnull=True, job_ids__isnull=False,
+                    creation_date__gte=cutoff)
+            .only('job_ids'))
+    held = Counter()
+    for run in runs:
+        for id_, hostname in normalize(run.job_ids):
+            held[hostname] += 1
+    return held
+
+
+def ogusa_host_order(hostnames):
+    '''
+    hostnames from the one holding the fewest OG-USA jobs to the one
+    holding the most. Hosts holding as many jobs take turns, starting at
+    a round robin position shared by the web processes
+    '''
+    held = ogusa_jobs_held()
+    offset = OGUSA_ALLOCATOR.allocate(1)
+    num_hosts = len(hostnames)
+    order = sorted(range(num_hosts),
+                   key=lambda idx: (held[hostnames[idx]],
+                                    (idx - offset) % num_hosts))
+    return [hostnames[idx] for idx in order]
 
 
 class DynamicCompute(DropqCompute):
 
-    def remote_register_job(self, theurl, data, timeout=TIMEOUT_IN_SECONDS):
-        response = requests.post(theurl, data=data, timeout=timeout)
-        return response
+    def __init__(self):
+        super(DynamicCompute, self).__init__()
+        HOST_HEALTH.watch(OGUSA_WORKERS)
 
     def submit_ogusa_calculation(self, mods, first_budget_year, microsim_data):
         print "mods is ", mods
         ogusa_mods = filter_ogusa_only(mods)
-        microsim_params = package_up_vars(microsim_data, first_budget_year)
+        microsim_params = package_up_arrays(microsim_data, first_budget_year)
         print "submit dynamic work"
         print "ogusa_mods is ", ogusa_mods
 
-        hostnames = OGUSA_WORKERS
+        # Try the hosts holding the fewest jobs first
+        hostnames = ogusa_host_order(HOST_HEALTH.available(OGUSA_WORKERS))
 
         DEFAULT_PARAMS = {
             'callback': "http://{}/dynamic/dynamic_finished".format(CALLBACK_HOSTNAME),
@@ -52,8 +94,8 @@ class DynamicCompute(DropqCompute):
         data['first_year'] = first_budget_year
         job_ids = []
         guids = []
-        hostname_idx = get_ogusa_worker_idx()
-        print "hostname_idx is", hostname_idx
+        hostname_idx = 0
+        print "hostnames are", hostnames
         submitted = False
         registered = False
         attempts = 0
@@ -63,24 +105,28 @@ class DynamicCompute(DropqCompute):
                 response = self.remote_submit_job(theurl, data=data, timeout=TIMEOUT_IN_SECONDS)
                 if response.status_code == 200:
                     print "submitted: ", hostnames[hostname_idx]
+                    HOST_HEALTH.record_success(hostnames[hostname_idx])
                     submitted = True
                     resp_data = json.loads(response.text)
                     job_ids.append((resp_data['job_id'], hostnames[hostname_idx]))
                     guids.append((resp_data['job_id'], resp_data.get('guid', 'None')))
                 else:
                     print "FAILED: ", hostnames[hostname_idx]
+                    HOST_HEALTH.record_failure(hostnames[hostname_idx])
+                    hostname_idx = (hostname_idx + 1) % len(hostnames)
                     attempts += 1
             except Timeout:
                 print "Couldn't submit to: ", hostnames[hostname_idx]
-                increment_ogusa_worker_idx()
+                HOST_HEALTH.record_failure(hostnames[hostname_idx])
+                hostname_idx = (hostname_idx + 1) % len(hostnames)
                 attempts += 1
             except RequestException as re:
                 print "Something unexpected happened: ", re
-                increment_ogusa_worker_idx()
+                HOST_HEALTH.record_failure(hostnames[hostname_idx])
+                hostname_idx = (hostname_idx + 1) % len(hostnames)
                 attempts += 1
             if attempts > MAX_ATTEMPTS_SUBMIT_JOB:
                 print "Exceeded max attempts. Bailing out."
-                increment_ogusa_worker_idx()
                 raise IOError()
 
         params = DEFAULT_PARAMS.copy()
@@ -111,9 +157,6 @@ class DynamicCompute(DropqCompute):
                 print "Exceeded max attempts. Bailing out."
                 raise IOError()
 
-        # We increment upon exceptions to submit, but once we have submitted and
-        # registered, increment again to move to the next OGUSA worker node
-        increment_ogusa_worker_idx()
         return job_ids, guids
 
     def ogusa_get_results(self, job_ids, status):
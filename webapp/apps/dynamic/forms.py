@@ -182,7 +182,7 @@ class DynamicElasticityInputsModelForm(ModelForm):
 
     class Meta:
         model = DynamicElasticitySaveInputs
-        exclude = ['creation_date']
+        exclude = ['creation_date', 'result_cache_key']
         widgets = {}
         labels = {}
         for param in ELASTICITY_DEFAULT_PARAMS.values():
@@ -377,7 +377,7 @@ class DynamicBehavioralInputsModelForm(ModelForm):
 
     class Meta:
         model = DynamicBehaviorSaveInputs
-        exclude = ['creation_date']
+        exclude = ['creation_date', 'result_cache_key', 'tables_json']
         widgets = {}
         labels = {}
         for param in BEHAVIOR_DEFAULT_PARAMS.values():
@@ -13,7 +13,8 @@ MOCK_MODULES = ['numba', 'numba.jit', 'numba.vectorize', 'numba.guvectorize',
                 
 sys.modules.update((mod_name, Mock()) for mod_name in MOCK_MODULES)
 
-from ..taxbrain.helpers import TaxCalcParam, package_up_vars, default_taxcalc_data
+from ..taxbrain.helpers import (TaxCalcParam, package_up_vars, default_taxcalc_data,
+                               cache_defaults)
 from ..taxbrain.compute import ELASTIC_RESULTS_TOTAL_ROW_KEYS 
 from django.core.mail import send_mail
 import requests
@@ -22,7 +23,6 @@ ogusa_workers = os.environ.get('OGUSA_WORKERS', '')
 OGUSA_WORKERS = ogusa_workers.split(",")
 dropq_workers = os.environ.get('DROPQ_WORKERS', '')
 DROPQ_WORKERS = dropq_workers.split(",")
-OGUSA_WORKER_IDX = 0
 CALLBACK_HOSTNAME = os.environ.get('CALLBACK_HOSTNAME', 'localhost:8000')
 ENFORCE_REMOTE_VERSION_CHECK = os.environ.get('ENFORCE_VERSION', 'False') == 'True'
 
@@ -90,14 +90,6 @@ def normalize(x):
     return ans
 
 
-def increment_ogusa_worker_idx():
-    global OGUSA_WORKER_IDX
-    OGUSA_WORKER_IDX = (OGUSA_WORKER_IDX + 1) % len(OGUSA_WORKERS)
-
-def get_ogusa_worker_idx():
-    global OGUSA_WORKER_IDX
-    return OGUSA_WORKER_IDX
-
 #
 # Prepare user params to send to DropQ/Taxcalc
 #
@@ -140,6 +132,7 @@ def convert_to_floats(tsi):
     return {k: numberfy(v) for k, v in attrs.items() if v}
 
 
+@cache_defaults
 def default_behavior_parameters(first_budget_year):
     ''' Create a list of default Behavior parameters '''
     default_behavior_params = {}
@@ -154,6 +147,7 @@ def default_behavior_parameters(first_budget_year):
     return default_behavior_params
 
 
+@cache_defaults
 def default_elasticity_parameters(first_budget_year):
     ''' Create a list of default Elasticity parameters '''
     default_elasticity_params = {}
@@ -179,6 +173,7 @@ def default_elasticity_parameters(first_budget_year):
     return default_elasticity_params
 
 
+@cache_defaults
 def default_parameters(first_budget_year):
     ''' Create a list of default parameters '''
 
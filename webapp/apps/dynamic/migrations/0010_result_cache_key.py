@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynamic', '0009_auto_20160224_0420'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicbehaviorsaveinputs',
+            name='result_cache_key',
+            field=models.CharField(default=None, max_length=64, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='dynamicelasticitysaveinputs',
+            name='result_cache_key',
+            field=models.CharField(default=None, max_length=64, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynamic', '0010_result_cache_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicbehaviorsaveinputs',
+            name='tables_json',
+            field=models.TextField(default=None, null=True, blank=True),
+        ),
+    ]
@@ -77,6 +77,13 @@ class DynamicBehaviorSaveInputs(models.Model):
     # Creation DateTime
     creation_date = models.DateTimeField(default=datetime.datetime(2015, 1, 1))
 
+    # Key of this run's results in the CachedResult table
+    result_cache_key = models.CharField(blank=True, default=None, null=True,
+                                        max_length=64)
+    # The results tables shown on the results page, serialized when the
+    # results are stored
+    tables_json = models.TextField(blank=True, default=None, null=True)
+
     micro_sim = models.ForeignKey(OutputUrl, blank=True, null=True,
                                   on_delete=models.SET_NULL)
 
@@ -105,6 +112,10 @@ class DynamicElasticitySaveInputs(models.Model):
     # Creation DateTime
     creation_date = models.DateTimeField(default=datetime.datetime(2015, 1, 1))
 
+    # Key of this run's results in the CachedResult table
+    result_cache_key = models.CharField(blank=True, default=None, null=True,
+                                        max_length=64)
+
     micro_sim = models.ForeignKey(OutputUrl, blank=True, null=True,
                                   on_delete=models.SET_NULL)
 
@@ -114,17 +114,14 @@ class DynamicOGUSAViewsTests(TestCase):
                                       start_year)
 
 
-    def test_ogusa_round_robins(self):
+    def test_ogusa_spreads_jobs(self):
         # Do the microsim
         start_year = 2015
         self.client.login(username='temporary', password='temporary')
 
         import sys
-        from webapp.apps.dynamic import helpers
         from webapp.apps.dynamic import compute
         # Monkey patch the variables we need to test
-        helpers.OGUSA_WORKER_IDX = 0
-        helpers.OGUSA_WORKERS = ['host1', 'host2', 'host3']
         compute.OGUSA_WORKERS = ['host1', 'host2', 'host3']
 
         reform = {u'ID_BenefitSurtax_Switch_1': [u'True'],
@@ -141,22 +138,19 @@ class DynamicOGUSAViewsTests(TestCase):
         # Do a 2015 microsim
         micro_2015 = do_micro_sim(self.client, reform)
 
-        #Assert the the worker node index has been reset to 0
-        assert helpers.get_ogusa_worker_idx() == 0
+        # No host holds any jobs yet
+        assert sum(compute.ogusa_jobs_held().values()) == 0
 
         # Do the ogusa simulation based on this microsim
         ogusa_reform = {u'frisch': [u'0.42']}
-        ogusa_status_code = 403  # Should raise an error on no email address
-        ogusa_response = do_ogusa_sim(self.client, micro_2015, ogusa_reform,
-                                      start_year)
+        do_ogusa_sim(self.client, micro_2015, ogusa_reform, start_year)
 
-        #Assert the the worker node index has incremented
-        assert helpers.get_ogusa_worker_idx() == 1
+        # The job is held by one of the hosts
+        assert sum(compute.ogusa_jobs_held().values()) == 1
 
         ogusa_reform = {u'frisch': [u'0.42']}
-        ogusa_status_code = 403  # Should raise an error on no email address
-        ogusa_response = do_ogusa_sim(self.client, micro_2015, ogusa_reform,
-                                      start_year)
+        do_ogusa_sim(self.client, micro_2015, ogusa_reform, start_year)
 
-        #Assert the the worker node index has incremented again
-        assert helpers.get_ogusa_worker_idx() == 2
+        # The second job goes to a host without one
+        held = compute.ogusa_jobs_held()
+        assert sorted(held.values()) == [1, 1]
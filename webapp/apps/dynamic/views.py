@@ -32,10 +32,15 @@ from .forms import (DynamicInputsModelForm, DynamicBehavioralInputsModelForm,
 from .models import (DynamicSaveInputs, DynamicOutputUrl,
                      DynamicBehaviorSaveInputs, DynamicBehaviorOutputUrl,
                      DynamicElasticitySaveInputs, DynamicElasticityOutputUrl)
-from ..taxbrain.models import TaxSaveInputs, OutputUrl
+from ..taxbrain.models import TaxSaveInputs, OutputUrl, RUN_RESULT_FIELDS
 from ..taxbrain.views import growth_fixup, benefit_surtax_fixup, make_bool
-from ..taxbrain.helpers import default_policy, taxcalc_results_to_tables, default_behavior
-from ..taxbrain.views import dropq_compute
+from ..taxbrain.helpers import default_policy, default_behavior
+from ..taxbrain.views import dropq_compute, tables_with_tooltips
+from ..taxbrain.collector import (assemble_results, cached_results,
+                                  save_results, stored_tables_json,
+                                  record_run_jobs)
+from ..taxbrain.columnar import load_tax_result
+from ..taxbrain.eta import start_timing
 
 from .helpers import (default_parameters, job_submitted,
                       ogusa_results_to_tables, success_text,
@@ -47,13 +52,11 @@ from .helpers import (default_parameters, job_submitted,
 from .compute import DynamicCompute
 dynamic_compute = DynamicCompute()
 
-from ..taxbrain.constants import (DIAGNOSTIC_TOOLTIP, DIFFERENCE_TOOLTIP,
-                                  PAYROLL_TOOLTIP, INCOME_TOOLTIP, BASE_TOOLTIP,
-                                  REFORM_TOOLTIP, EXPANDED_TOOLTIP,
-                                  ADJUSTED_TOOLTIP, INCOME_BINS_TOOLTIP,
-                                  INCOME_DECILES_TOOLTIP)
-
-
+# Columns of the microsim run left out of the data sent with a dynamic run
+MICROSIM_SKIPPED_FIELDS = RUN_RESULT_FIELDS + ('result_cache_key',)
+# Columns read while waiting for the results of a dynamic run
+DYNAMIC_STATUS_FIELDS = ('job_ids', 'first_year', 'tax_result',
+                         'result_cache_key')
 
 tcversion_info = taxcalc._version.get_versions()
 taxcalc_version = ".".join([tcversion_info['version'], tcversion_info['full'][:6]])
@@ -96,7 +99,9 @@ def dynamic_input(request, pk):
             #get microsim data
             outputsurl = OutputUrl.objects.get(pk=pk)
             model.micro_sim = outputsurl
-            taxbrain_model = outputsurl.unique_inputs
+            taxbrain_model = (TaxSaveInputs.objects
+                              .defer(*MICROSIM_SKIPPED_FIELDS)
+                              .get(pk=outputsurl.unique_inputs_id))
             taxbrain_dict = dict(taxbrain_model.__dict__)
             growth_fixup(taxbrain_dict)
             for key, value in taxbrain_dict.items():
@@ -123,6 +128,8 @@ def dynamic_input(request, pk):
                 model.job_ids = denormalize(submitted_ids)
                 model.guids = denormalize(guids)
                 model.first_year = int(start_year)
+                # Marks when the job went out, until the results replace it
+                model.creation_date = datetime.datetime.now()
                 if request.user.is_authenticated():
                     current_user = User.objects.get(pk=request.user.id)
                     model.user_email = current_user.email
@@ -200,7 +207,9 @@ def dynamic_behavioral(request, pk):
             #get microsim data 
             outputsurl = OutputUrl.objects.get(pk=pk)
             model.micro_sim = outputsurl
-            taxbrain_model = outputsurl.unique_inputs
+            taxbrain_model = (TaxSaveInputs.objects
+                              .defer(*MICROSIM_SKIPPED_FIELDS)
+                              .get(pk=outputsurl.unique_inputs_id))
             taxbrain_dict = dict(taxbrain_model.__dict__)
             growth_fixup(taxbrain_dict)
             for key, value in taxbrain_dict.items():
@@ -222,15 +231,27 @@ def dynamic_behavioral(request, pk):
 
             microsim_data.update(worker_data)
 
-            # start calc job
-            submitted_ids, max_q_length = dropq_compute.submit_dropq_calculation(microsim_data, int(start_year))
-            if not submitted_ids:
+            # start calc job, unless an identical run was already computed
+            cache_key, cached = cached_results(microsim_data, int(start_year),
+                                               'behavior')
+            if cached is not None:
+                submitted_ids = []
+            else:
+                submitted_ids, max_q_length = dropq_compute.submit_dropq_calculation(microsim_data, int(start_year))
+            if not submitted_ids and cached is None:
                 no_inputs = True
                 form_personal_exemp = personal_inputs
             else:
-                model.job_ids = denormalize(submitted_ids)
+                if submitted_ids:
+                    model.job_ids = denormalize(submitted_ids)
                 model.first_year = int(start_year)
+                model.result_cache_key = cache_key
                 model.save()
+                if cached is not None:
+                    save_results(model, cached)
+                else:
+                    record_run_jobs(model, submitted_ids)
+                    start_timing(model, 'behavior', submitted_ids, max_q_length)
                 return redirect('behavior_results', model.pk)
 
         else:
@@ -304,7 +325,9 @@ def dynamic_elasticities(request, pk):
             #get microsim data 
             outputsurl = OutputUrl.objects.get(pk=pk)
             model.micro_sim = outputsurl
-            taxbrain_model = outputsurl.unique_inputs
+            taxbrain_model = (TaxSaveInputs.objects
+                              .defer(*MICROSIM_SKIPPED_FIELDS)
+                              .get(pk=outputsurl.unique_inputs_id))
             taxbrain_dict = dict(taxbrain_model.__dict__)
             growth_fixup(taxbrain_dict)
             for key, value in taxbrain_dict.items():
@@ -325,16 +348,28 @@ def dynamic_elasticities(request, pk):
             benefit_surtax_fixup(microsim_data)
             microsim_data.update(worker_data)
 
-            # start calc job
-            submitted_ids, max_q_length = dropq_compute.submit_elastic_calculation(microsim_data,
+            # start calc job, unless an identical run was already computed
+            cache_key, cached = cached_results(microsim_data, int(start_year),
+                                               'elastic')
+            if cached is not None:
+                submitted_ids = []
+            else:
+                submitted_ids, max_q_length = dropq_compute.submit_elastic_calculation(microsim_data,
                                                                      int(start_year))
-            if not submitted_ids:
+            if not submitted_ids and cached is None:
                 no_inputs = True
                 form_personal_exemp = personal_inputs
             else:
-                model.job_ids = denormalize(submitted_ids)
+                if submitted_ids:
+                    model.job_ids = denormalize(submitted_ids)
                 model.first_year = int(start_year)
+                model.result_cache_key = cache_key
                 model.save()
+                if cached is not None:
+                    save_results(model, cached)
+                else:
+                    record_run_jobs(model, submitted_ids)
+                    start_timing(model, 'elastic', submitted_ids, max_q_length)
                 return redirect('elastic_results', model.pk)
 
         else:
@@ -384,7 +419,7 @@ def edit_dynamic_behavioral(request, pk):
         'params': behavior_default_params,
         'taxcalc_version': taxcalc_version,
         'start_year': str(start_year),
-        'pk': model.micro_sim.pk
+        'pk': model.micro_sim_id
     }
 
     return render(request, 'dynamic/behavior.html', init_context)
@@ -416,7 +451,7 @@ def edit_dynamic_elastic(request, pk):
         'params': elasticity_default_params,
         'taxcalc_version': taxcalc_version,
         'start_year': str(start_year),
-        'pk': model.micro_sim.pk
+        'pk': model.micro_sim_id
     }
 
     return render(request, 'dynamic/elasticity.html', init_context)
@@ -459,7 +494,7 @@ def dynamic_finished(request):
 
     params = dynamic_params_from_model(dsi)
     hostname = os.environ.get('BASE_IRI', 'http://www.ospc.org')
-    microsim_url = hostname + "/taxbrain/" + str(dsi.micro_sim.pk)
+    microsim_url = hostname + "/taxbrain/" + str(dsi.micro_sim_id)
     #Create a new output model instance
     if status == "SUCCESS":
         unique_url = DynamicOutputUrl()
@@ -523,12 +558,15 @@ def elastic_output(request, pk):
         url.taxcalc_vers = taxcalc_version
         url.save()
 
-    output = url.unique_inputs.tax_result
-    first_year = url.unique_inputs.first_year
-    created_on = url.unique_inputs.creation_date
+    model = (DynamicElasticitySaveInputs.objects
+             .only('first_year', 'creation_date', 'tax_result', 'micro_sim')
+             .get(pk=url.unique_inputs_id))
+    output = load_tax_result(model)
+    first_year = model.first_year
+    created_on = model.creation_date
     tables = elast_results_to_tables(output, first_year)
     hostname = os.environ.get('BASE_IRI', 'http://www.ospc.org')
-    microsim_url = hostname + "/taxbrain/" + str(url.unique_inputs.micro_sim.pk)
+    microsim_url = hostname + "/taxbrain/" + str(model.micro_sim_id)
 
     context = {
         'locals':locals(),
@@ -566,7 +604,7 @@ def ogusa_results(request, pk):
     created_on = url.unique_inputs.creation_date
     tables = ogusa_results_to_tables(output, first_year)
     hostname = os.environ.get('BASE_IRI', 'http://www.ospc.org')
-    microsim_url = hostname + "/taxbrain/" + str(url.unique_inputs.micro_sim.pk)
+    microsim_url = hostname + "/taxbrain/" + str(url.unique_inputs.micro_sim_id)
 
     context = {
         'locals':locals(),
@@ -587,14 +625,19 @@ def elastic_results(request, pk):
     returned.
     """
 
-    model = DynamicElasticitySaveInputs.objects.get(pk=pk)
-    job_ids = model.job_ids
-    submitted_ids = normalize(job_ids)
-    if all(dropq_compute.dropq_results_ready(submitted_ids)):
-        model.tax_result = dropq_compute.elastic_get_results(submitted_ids)
-        model.creation_date = datetime.datetime.now()
-        model.save()
-
+    model = (DynamicElasticitySaveInputs.objects.only(*DYNAMIC_STATUS_FIELDS)
+             .get(pk=pk))
+    # The results may already have been saved from the worker callbacks
+    # or the result cache
+    if not model.tax_result:
+        submitted_ids = normalize(model.job_ids)
+        if all(dropq_compute.dropq_results_ready(submitted_ids)):
+            results = assemble_results(submitted_ids,
+                                       dropq_compute.elastic_merge_results,
+                                       dropq_compute)
+            save_results(model, results)
+
+    if model.tax_result:
         unique_url = DynamicElasticityOutputUrl()
         if request.user.is_authenticated():
             current_user = User.objects.get(pk=request.user.id)
@@ -613,14 +656,19 @@ def behavior_results(request, pk):
     This view allows the app to wait for the taxcalc results to be
     returned.
     """
-    model = DynamicBehaviorSaveInputs.objects.get(pk=pk)
-    job_ids = model.job_ids
-    submitted_ids = normalize(job_ids)
-    if all(dropq_compute.dropq_results_ready(submitted_ids)):
-        model.tax_result = dropq_compute.dropq_get_results(submitted_ids)
-        model.creation_date = datetime.datetime.now()
-        model.save()
-
+    model = (DynamicBehaviorSaveInputs.objects.only(*DYNAMIC_STATUS_FIELDS)
+             .get(pk=pk))
+    # The results may already have been saved from the worker callbacks
+    # or the result cache
+    if not model.tax_result:
+        submitted_ids = normalize(model.job_ids)
+        if all(dropq_compute.dropq_results_ready(submitted_ids)):
+            results = assemble_results(submitted_ids,
+                                       dropq_compute.dropq_merge_results,
+                                       dropq_compute)
+            save_results(model, results)
+
+    if model.tax_result:
         unique_url = DynamicBehaviorOutputUrl()
         if request.user.is_authenticated():
             current_user = User.objects.get(pk=request.user.id)
@@ -649,32 +697,21 @@ def behavior_output(request, pk):
         url.taxcalc_vers = taxcalc_version
         url.save()
 
-    output = url.unique_inputs.tax_result
-    first_year = url.unique_inputs.first_year
-    created_on = url.unique_inputs.creation_date
-    tables = taxcalc_results_to_tables(output, first_year)
-    tables["tooltips"] = {
-        'diagnostic': DIAGNOSTIC_TOOLTIP,
-        'difference': DIFFERENCE_TOOLTIP,
-        'payroll': PAYROLL_TOOLTIP,
-        'income': INCOME_TOOLTIP,
-        'base': BASE_TOOLTIP,
-        'reform': REFORM_TOOLTIP,
-        'expanded': EXPANDED_TOOLTIP,
-        'adjusted': ADJUSTED_TOOLTIP,
-        'bins': INCOME_BINS_TOOLTIP,
-        'deciles': INCOME_DECILES_TOOLTIP
-    }
-    dbsi = url.unique_inputs
+    dbsi = (DynamicBehaviorSaveInputs.objects
+            .only('first_year', 'creation_date', 'tax_result', 'micro_sim')
+            .get(pk=url.unique_inputs_id))
+    first_year = dbsi.first_year
+    created_on = dbsi.creation_date
+    tables = tables_with_tooltips(stored_tables_json(dbsi))
     is_registered = True if request.user.is_authenticated() else False
     hostname = os.environ.get('BASE_IRI', 'http://www.ospc.org')
-    microsim_url = hostname + "/taxbrain/" + str(dbsi.micro_sim.pk)
+    microsim_url = hostname + "/taxbrain/" + str(dbsi.micro_sim_id)
 
     context = {
         'locals':locals(),
         'unique_url':url,
         'taxcalc_version':taxcalc_version,
-        'tables': json.dumps(tables),
+        'tables': tables,
         'created_on': created_on,
         'first_year': first_year,
         'is_registered': is_registered,
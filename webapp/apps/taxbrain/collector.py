@@ -0,0 +1,327 @@
+import datetime
+import json
+import os
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from .models import (TaxSaveInputs, DropqYearResult, CachedResult, RunJob,
+                     RUN_STATUS_FIELDS)
+from .helpers import normalize, denormalize, taxcalc_results_to_tables
+from .compute import JobFailError, USE_RESULT_CACHE, result_cache_key
+from .columnar import COLUMNAR_RESULTS, store_tables, load_tax_result
+from .eta import finish_timing
+from .events import publish_progress
+
+# Set when a collect_results management command is running, in which
+# case the views only read the results it saves from the database
+BACKGROUND_COLLECTOR = os.environ.get('BACKGROUND_COLLECTOR', 'False') == 'True'
+
+
+def cached_results(mods, first_budget_year, run_type):
+    """
+    Look up the results of an earlier run identical to this one. Returns
+    the run's cache key together with the cached results, which are None
+    if no such run has finished yet
+    """
+    if not USE_RESULT_CACHE:
+        return None, None
+    key = result_cache_key(mods, first_budget_year, run_type)
+    if key is None:
+        return None, None
+    cached = CachedResult.objects.filter(key=key).first()
+    if cached is None or cached.tax_result is None:
+        return key, None
+    return key, load_tax_result(cached)
+
+
+def results_tables_json(results, first_year):
+    """ The serialized results tables of dropq results """
+    return json.dumps(taxcalc_results_to_tables(results, first_year))
+
+
+def stored_tables_json(model):
+    """
+    The serialized results tables of a run with results. Runs stored
+    before the tables were saved with the results get them saved now
+    """
+    if not model.tables_json:
+        model.tables_json = results_tables_json(load_tax_result(model),
+                                                model.first_year)
+        model.save(update_fields=['tables_json'])
+    return model.tables_json
+
+
+def save_results(model, results):
+    """
+    Save the merged results of a run on its model, as ResultTables unless
+    COLUMNAR_RESULTS is off, along with its results tables if the model
+    keeps them, and in the result cache under the model's
+    result_cache_key, if it has one, stored the same way. The run's
+    timings are completed, its jobs forgotten and the requests waiting on
+    its progress woken
+    """
+    model.tax_result = results
+    if hasattr(model, 'tables_json'):
+        model.tables_json = results_tables_json(results, model.first_year)
+    if COLUMNAR_RESULTS:
+        model.tax_result = store_tables(model, results)
+    model.creation_date = datetime.datetime.now()
+    model.save()
+    finish_timing(model)
+    RunJob.objects.filter(content_type=ContentType.objects.get_for_model(model),
+                          object_id=model.pk).delete()
+    publish_progress(model)
+    key = getattr(model, 'result_cache_key', None)
+    if USE_RESULT_CACHE and key:
+        cache_results(key, results)
+
+
+def cache_results(key, results):
+    """
+    Save results in the result cache under key, unless another run saved
+    them first. The entry is created in the same transaction as its tables,
+    so it is never seen without them, and entries left without them by
+    earlier versions are filled in
+    """
+    with transaction.atomic():
+        cached, created = (CachedResult.objects.select_for_update()
+                           .get_or_create(key=key))
+        if cached.tax_result is not None:
+            return
+        if COLUMNAR_RESULTS:
+            cached.tax_result = store_tables(cached, results)
+        else:
+            cached.tax_result = results
+        cached.save(update_fields=['tax_result'])
+
+
+def year_payloads(job_ids, compute):
+    """
+    Yield the payload of every (job_id, hostname) pair in job_ids, using
+    the results saved from worker callbacks and downloading only the
+    years that have none
+    """
+    ids = [id_ for id_, hostname in job_ids]
+    stored = set()
+    year_results = DropqYearResult.objects.filter(job_id__in=ids,
+                                                  status="SUCCESS")
+    for year_result in year_results.iterator():
+        stored.add(year_result.job_id)
+        yield year_result.result
+
+    missing = [(id_, hostname) for id_, hostname in job_ids
+               if id_ not in stored]
+    for payload in compute.retrieve_results(missing):
+        yield payload
+
+
+def assemble_results(job_ids, merge, compute):
+    """
+    Merge the payloads of all years in job_ids with merge, one of the
+    compute's *_merge_results methods, and drop the saved year results
+    that are no longer needed
+    """
+    results = merge(year_payloads(job_ids, compute))
+    ids = [id_ for id_, hostname in job_ids]
+    DropqYearResult.objects.filter(job_id__in=ids).delete()
+    return results
+
+
+def collect_results(model, compute):
+    """
+    Check on the dropq jobs of a TaxSaveInputs model that has no results
+    yet. When every year is done, download and save the results and return
+    True. Otherwise remember the jobs still running in jobs_not_ready and
+    return False. If a job has failed, the model is marked as failed and
+    the JobFailError is raised again
+    """
+    job_ids = model.job_ids
+    jobs_to_check = model.jobs_not_ready
+    if not jobs_to_check:
+        jobs_to_check = normalize(job_ids)
+    else:
+        jobs_to_check = normalize(jobs_to_check)
+
+    # Years the workers already reported through a callback need no polling
+    ids = [id_ for id_, hostname in jobs_to_check]
+    reported = dict(DropqYearResult.objects.filter(job_id__in=ids)
+                    .values_list('job_id', 'status'))
+    jobs_to_check = [sub_id for sub_id in jobs_to_check
+                     if sub_id[0] not in reported]
+
+    try:
+        if "FAILURE" in reported.values():
+            failed = [id_ for id_ in reported if reported[id_] == "FAILURE"]
+            raise JobFailError('{0} failed'.format(failed[0]))
+        jobs_ready = compute.dropq_results_ready(jobs_to_check)
+    except JobFailError:
+        model.job_failed = True
+        model.save()
+        publish_progress(model)
+        raise
+
+    if all(jobs_ready):
+        results = assemble_results(normalize(job_ids),
+                                   compute.dropq_merge_results, compute)
+        save_results(model, results)
+        return True
+    else:
+        jobs_not_ready = [sub_id for (sub_id, job_ready) in
+                            zip(jobs_to_check, jobs_ready) if not job_ready]
+        model.jobs_not_ready = denormalize(jobs_not_ready)
+        model.save()
+        if len(jobs_not_ready) < len(jobs_to_check):
+            publish_progress(model)
+        return False
+
+
+def callback_run_models():
+    """
+    The models of the runs that are computed by dropq workers, each paired
+    with the name of the compute method that merges their results
+    """
+    from ..dynamic.models import (DynamicBehaviorSaveInputs,
+                                  DynamicElasticitySaveInputs)
+    return [(TaxSaveInputs, 'dropq_merge_results'),
+            (DynamicBehaviorSaveInputs, 'dropq_merge_results'),
+            (DynamicElasticitySaveInputs, 'elastic_merge_results')]
+
+
+def run_input_fields(model_cls):
+    """
+    The parameter columns of a run model, which the collection of its
+    results never reads
+    """
+    keep = set(RUN_STATUS_FIELDS) | set(['id', 'tables_json', 'micro_sim'])
+    return [f.name for f in model_cls._meta.concrete_fields
+            if f.name not in keep]
+
+
+def record_run_jobs(model, job_ids):
+    """
+    Remember the run of model as the one of job_ids, (job_id, hostname)
+    pairs, for the callbacks of the workers doing them
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    RunJob.objects.bulk_create([
+        RunJob(job_id=id_, hostname=hostname, content_type=content_type,
+               object_id=model.pk)
+        for id_, hostname in job_ids])
+
+
+def job_run(job_id):
+    """
+    The model of the unfinished run job_id was submitted for, loaded
+    without its parameters, with the name of the compute method merging
+    its results and the host doing the job, or None if there is none
+    """
+    merge_names = dict(callback_run_models())
+    run_jobs = RunJob.objects.filter(job_id=job_id).select_related('content_type')
+    for run_job in run_jobs:
+        model_cls = run_job.content_type.model_class()
+        if model_cls not in merge_names:
+            continue
+        model = (model_cls.objects
+                 .filter(pk=run_job.object_id, tax_result__isnull=True)
+                 .defer(*run_input_fields(model_cls)).first())
+        if model is not None:
+            return model, merge_names[model_cls], run_job.hostname
+    return None
+
+
+def record_year_result(job_id, status, compute):
+    """
+    Save the outcome of one year's job, as reported by a worker callback.
+    The outcome is confirmed with the worker before it is stored. When the
+    last year of a run arrives, the run's results are assembled and saved,
+    by only one of the callbacks if the last years arrive together.
+    Returns the model of the run owning job_id, or None if there is none
+    """
+    if status not in ("SUCCESS", "FAILURE"):
+        raise ValueError("status must be either 'SUCCESS' or 'FAILURE'")
+
+    run = job_run(job_id)
+    if run is None:
+        return None
+    model, merge_name, hostname = run
+
+    if status == "SUCCESS":
+        payload = compute.retrieve_year_result(job_id, hostname)
+        if payload is None:
+            # Not actually available, polling will pick it up later
+            return model
+        DropqYearResult.objects.create(job_id=job_id, hostname=hostname,
+                                       status=status, result=payload)
+        publish_progress(model)
+    else:
+        if compute.host_results_ready(hostname, [(0, job_id)]) != [(0, 'FAIL')]:
+            return model
+        DropqYearResult.objects.create(job_id=job_id, hostname=hostname,
+                                       status=status)
+        if hasattr(model, 'job_failed'):
+            model.job_failed = True
+            model.save()
+        publish_progress(model)
+        return model
+
+    job_ids = normalize(model.job_ids)
+    ids = set(id_ for id_, _ in job_ids)
+    num_done = (DropqYearResult.objects
+                .filter(job_id__in=ids, status="SUCCESS")
+                .values('job_id').distinct().count())
+    if num_done < len(ids):
+        return model
+
+    model_cls = model._meta.concrete_model
+    with transaction.atomic():
+        # Whichever callback locks the run first saves its results, the
+        # others find them saved once they get the lock
+        unfinished = (model_cls.objects.select_for_update()
+                      .filter(pk=model.pk, tax_result__isnull=True)
+                      .values_list('pk', flat=True))
+        if not list(unfinished):
+            return model
+        results = assemble_results(job_ids, getattr(compute, merge_name),
+                                   compute)
+        save_results(model, results)
+    # Waiters woken before the results were committed may have missed them
+    publish_progress(model)
+    return model
+
+
+def run_progress(model):
+    """
+    The state of a run, 'running', 'done' or 'failed', with the number of
+    its years that are done out of all of them. A year is done once a
+    worker has reported it, or a poll found it ready
+    """
+    job_ids = normalize(model.job_ids) if model.job_ids else []
+    ids = [id_ for id_, hostname in job_ids]
+    if model.tax_result:
+        state, done = 'done', set(ids)
+    else:
+        state = 'failed' if model.job_failed else 'running'
+        done = set()
+        if model.jobs_not_ready:
+            not_ready = set(id_ for id_, hostname in
+                            normalize(model.jobs_not_ready))
+            done = set(ids) - not_ready
+        if ids:
+            done.update(DropqYearResult.objects
+                        .filter(job_id__in=ids, status="SUCCESS")
+                        .values_list('job_id', flat=True))
+    return {'state': state, 'years_done': len(done), 'years': len(ids)}
+
+
+def outstanding_runs(max_age):
+    """
+    TaxSaveInputs models that were submitted to the workers within the
+    last max_age (a timedelta) and have neither results nor a failure
+    """
+    cutoff = datetime.datetime.utcnow() - max_age
+    qs = TaxSaveInputs.objects.filter(tax_result__isnull=True,
+                                      job_ids__isnull=False,
+                                      job_failed=False,
+                                      outputurl__exp_comp_datetime__gte=cutoff)
+    return qs.only(*RUN_STATUS_FIELDS).distinct()
@@ -0,0 +1,239 @@
+"""
+Compact storage for the results of dropq runs.
+
+Each table of a run's tax_result, e.g. mY_dec, maps keys like
+'perc10-20_3' (row key and budget year) to a list of string-formatted
+numbers, or to a single one. A table is stored in its own ResultTable row
+as a versioned, zlib compressed blob. The first byte of a blob gives its
+format:
+
+    0: the table as JSON
+    1: the table as columns: a JSON header with the row keys and the
+       number of years and columns, then float64 values, int8 numbers of
+       decimals and uint8 flags for every (row, year, column) cell
+
+Format 1 reproduces the original strings exactly. Tables with a cell it
+can't reproduce are stored in format 0 instead.
+"""
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+from django.contrib.contenttypes.models import ContentType
+
+from .models import ResultTable
+
+COLUMNAR_RESULTS = os.environ.get('COLUMNAR_RESULTS', 'True') == 'True'
+FORMAT_JSON = 0
+FORMAT_COLUMNAR = 1
+# Marker key saved in tax_result in place of tables stored as ResultTables
+COLUMNAR_KEY = 'columnar_format'
+
+PERCENT = 1
+NOT_AVAILABLE = 2
+MISSING = 4
+
+
+def parse_cell(s):
+    """ The value, number of decimals and flags of a formatted number """
+    if s == 'n/a':
+        return 0.0, 0, NOT_AVAILABLE
+    flags = 0
+    if s.endswith('%'):
+        flags = PERCENT
+        s = s[:-1]
+    idx = s.find('.')
+    decimals = len(s) - idx - 1 if idx >= 0 else 0
+    return float(s), decimals, flags
+
+
+def format_cell(value, decimals, flags):
+    """ The inverse of parse_cell """
+    if flags & NOT_AVAILABLE:
+        return 'n/a'
+    s = '%.*f' % (decimals, value)
+    if flags & PERCENT:
+        s += '%'
+    return s
+
+
+def split_key(key):
+    """ Split a key like 'perc10-20_3' into its row key and year """
+    idx = key.rfind('_')
+    return key[:idx], int(key[idx + 1:])
+
+
+def encode_columns(table):
+    """
+    The format 1 payload of a table, or None if the table's cells can't
+    all be reproduced from it
+    """
+    rows = []
+    row_idx = {}
+    num_years = 0
+    num_cols = 1
+    scalar = None
+    try:
+        for key, cells in table.items():
+            row, year = split_key(key)
+            if row not in row_idx:
+                row_idx[row] = len(rows)
+                rows.append(row)
+            num_years = max(num_years, year + 1)
+            is_scalar = not isinstance(cells, list)
+            if scalar is None:
+                scalar = is_scalar
+            elif scalar != is_scalar:
+                return None
+            if not is_scalar:
+                num_cols = max(num_cols, len(cells))
+    except ValueError:
+        return None
+
+    shape = (len(rows), num_years, num_cols)
+    values = np.zeros(shape, dtype='<f8')
+    decimals = np.zeros(shape, dtype='i1')
+    flags = np.full(shape, MISSING, dtype='u1')
+    for key, cells in table.items():
+        row, year = split_key(key)
+        if scalar:
+            cells = [cells]
+        for col, cell in enumerate(cells):
+            if not isinstance(cell, basestring):
+                return None
+            try:
+                value, dec, flag = parse_cell(cell)
+            except ValueError:
+                return None
+            if dec > 127 or format_cell(value, dec, flag) != cell:
+                return None
+            idx = (row_idx[row], year, col)
+            values[idx] = value
+            decimals[idx] = dec
+            flags[idx] = flag
+
+    header = json.dumps({'rows': rows, 'years': num_years, 'cols': num_cols,
+                         'scalar': bool(scalar)})
+    return (struct.pack('<I', len(header)) + header + values.tobytes() +
+            decimals.tobytes() + flags.tobytes())
+
+
+def decode_columns(payload):
+    """ The table stored in a format 1 payload """
+    header_len, = struct.unpack('<I', payload[:4])
+    header = json.loads(payload[4:4 + header_len])
+    rows, num_years, num_cols = header['rows'], header['years'], header['cols']
+    shape = (len(rows), num_years, num_cols)
+    size = len(rows) * num_years * num_cols
+    offset = 4 + header_len
+    values = np.frombuffer(payload, dtype='<f8', count=size, offset=offset)
+    offset += 8 * size
+    decimals = np.frombuffer(payload, dtype='i1', count=size, offset=offset)
+    offset += size
+    flags = np.frombuffer(payload, dtype='u1', count=size, offset=offset)
+
+    values = values.reshape(shape).tolist()
+    decimals = decimals.reshape(shape).tolist()
+    flags = flags.reshape(shape).tolist()
+    table = {}
+    for r, row in enumerate(rows):
+        for year in range(num_years):
+            row_flags = flags[r][year]
+            cells = [format_cell(values[r][year][col], decimals[r][year][col],
+                                 row_flags[col])
+                     for col in range(num_cols) if not row_flags[col] & MISSING]
+            if not cells:
+                continue
+            key = "{0}_{1}".format(row, year)
+            table[key] = cells[0] if header['scalar'] else cells
+    return table
+
+
+def encode_table(table):
+    """ The compressed blob of one results table """
+    payload = encode_columns(table)
+    if payload is None:
+        return chr(FORMAT_JSON) + zlib.compress(json.dumps(table))
+    return chr(FORMAT_COLUMNAR) + zlib.compress(payload)
+
+
+def decode_table(blob):
+    """ The results table stored in a blob made by encode_table """
+    if isinstance(blob, memoryview):
+        blob = blob.tobytes()
+    blob = bytes(blob)
+    version = ord(blob[0])
+    payload = zlib.decompress(blob[1:])
+    if version == FORMAT_JSON:
+        return json.loads(payload)
+    elif version == FORMAT_COLUMNAR:
+        return decode_columns(payload)
+    raise ValueError("Unknown results table format {0}".format(version))
+
+
+def is_columnar(tax_result):
+    return isinstance(tax_result, dict) and COLUMNAR_KEY in tax_result
+
+
+def store_tables(model, results):
+    """
+    Store the tables of results as ResultTables of model, and return the
+    marker to save in the model's tax_result in their place. Entries of
+    results that aren't tables are kept in the marker
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    marker = {COLUMNAR_KEY: FORMAT_COLUMNAR}
+    ResultTable.objects.filter(content_type=content_type,
+                               object_id=model.pk).delete()
+    result_tables = []
+    for table_id, table in results.items():
+        if isinstance(table, dict):
+            result_tables.append(ResultTable(content_type=content_type,
+                                             object_id=model.pk,
+                                             table_id=table_id,
+                                             data=encode_table(table)))
+        else:
+            marker[table_id] = table
+    ResultTable.objects.bulk_create(result_tables)
+    return marker
+
+
+def load_tax_result(model, table_ids=None):
+    """
+    The tax_result of model, with only the tables in table_ids if given.
+    Only those tables are read and decoded for results stored as
+    ResultTables
+    """
+    return load_tax_results([model], table_ids)[model.pk]
+
+
+def load_tax_results(models, table_ids=None):
+    """
+    The tax_results of models, all of the same class, by pk. The
+    ResultTables of all of them are read with a single query
+    """
+    results = {}
+    columnar_pks = []
+    for model in models:
+        tax_result = model.tax_result
+        if is_columnar(tax_result):
+            tax_result = {k: v for k, v in tax_result.items()
+                          if k != COLUMNAR_KEY}
+            columnar_pks.append(model.pk)
+        if tax_result is not None and table_ids is not None:
+            tax_result = {k: v for k, v in tax_result.items()
+                          if k in table_ids}
+        results[model.pk] = tax_result
+
+    if columnar_pks:
+        content_type = ContentType.objects.get_for_model(models[0])
+        qs = ResultTable.objects.filter(content_type=content_type,
+                                        object_id__in=columnar_pks)
+        if table_ids is not None:
+            qs = qs.filter(table_id__in=table_ids)
+        for object_id, table_id, data in qs.values_list('object_id',
+                                                        'table_id', 'data'):
+            results[object_id][table_id] = decode_table(data)
+    return results
@@ -1,11 +1,19 @@
 import dropq
 import os
-from .helpers import package_up_vars
-from .models import WorkerNodesCounter
 import json
+import hashlib
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import requests
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from requests.adapters import HTTPAdapter
 from requests.exceptions import Timeout, RequestException
-from .helpers import arrange_totals_by_row
+from .helpers import (arrange_totals_by_row, same_version, taxcalc_version,
+                      package_up_arrays)
 import requests_mock
 requests_mock.Mocker.TEST_PREFIX = 'dropq'
 
@@ -17,31 +25,439 @@ START_YEAR = int(os.environ.get('START_YEAR', 2016))
 dropq_workers = os.environ.get('DROPQ_WORKERS', '')
 DROPQ_WORKERS = dropq_workers.split(",")
 ENFORCE_REMOTE_VERSION_CHECK = os.environ.get('ENFORCE_VERSION', 'False') == 'True'
-TIMEOUT_IN_SECONDS = 1.0
+CALLBACK_HOSTNAME = os.environ.get('CALLBACK_HOSTNAME', 'localhost:8000')
+# Ask the workers to call back when each year's job is done
+DROPQ_CALLBACKS = os.environ.get('DROPQ_CALLBACKS', 'True') == 'True'
+TIMEOUT_IN_SECONDS = float(os.environ.get('SUBMIT_TIMEOUT', 1.0))
 MAX_ATTEMPTS_SUBMIT_JOB = 20
+# Number of threads used to talk to the workers concurrently
+DROPQ_DISPATCH_POOL_SIZE = int(os.environ.get('DROPQ_DISPATCH_POOL_SIZE', 10))
+# Timeouts for polling workers and downloading results
+CONNECT_TIMEOUT_IN_SECONDS = float(os.environ.get('CONNECT_TIMEOUT', 1.0))
+READ_TIMEOUT_IN_SECONDS = float(os.environ.get('READ_TIMEOUT', 60.0))
+# Number of hosts to keep connection pools for, and number of
+# kept-alive connections per host
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 50))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE',
+                                       DROPQ_DISPATCH_POOL_SIZE))
 TAXCALC_RESULTS_TOTAL_ROW_KEYS = dropq.dropq.total_row_names
 ELASTIC_RESULTS_TOTAL_ROW_KEYS = ["gdp_elasticity"]
+TAXCALC_RESULTS_TABLE_IDS = ['mY_dec', 'mX_dec', 'df_dec', 'pdf_dec',
+                             'cdf_dec', 'mY_bin', 'mX_bin', 'df_bin',
+                             'pdf_bin', 'cdf_bin', 'fiscal_tots']
+ELASTIC_RESULTS_TABLE_IDS = ['elasticity_gdp']
+# Answer runs identical to one already computed from the CachedResult table
+USE_RESULT_CACHE = os.environ.get('RESULT_CACHE', 'True') == 'True'
+# Queue lengths and latencies seen longer ago than this are not trusted
+HOST_LOAD_TTL_IN_SECONDS = float(os.environ.get('HOST_LOAD_TTL', 300.0))
+# Weight of the newest sample in the moving averages of host load
+HOST_LOAD_SMOOTHING = 0.5
+# Seconds of response latency that weigh as much as one queued job
+LATENCY_PER_QUEUED_JOB = float(os.environ.get('LATENCY_PER_QUEUED_JOB', 1.0))
+# Load added to a host whose last submission failed, so that it is only
+# used when every other host is at least this busy
+FAILED_HOST_LOAD = 1000.0
+# Consecutive failures after which a host is left out, and seconds after
+# which a host that was left out gets a trial request
+HOST_FAILURE_THRESHOLD = int(os.environ.get('HOST_FAILURE_THRESHOLD', 3))
+HOST_RESET_TIMEOUT_IN_SECONDS = float(os.environ.get('HOST_RESET_TIMEOUT', 30.0))
+# Seconds between the background probes of every worker host, 0 for none.
+# Without them a host that was left out only comes back through the trial
+# requests of user submissions
+HOST_HEARTBEAT_INTERVAL = float(os.environ.get('HOST_HEARTBEAT_INTERVAL', 30.0))
 
 
 class JobFailError(Exception):
     '''An Exception to raise when a remote jobs has failed'''
     pass
 
+
+def canonicalize(x):
+    '''
+    Return a copy of x, a structure of dicts, lists and numbers, that
+    serializes the same way however it was built: dict keys become
+    strings and floats holding whole numbers become ints
+    '''
+    if isinstance(x, dict):
+        return {str(k): canonicalize(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [canonicalize(v) for v in x]
+    if isinstance(x, bool):
+        return x
+    if hasattr(x, 'tolist'):
+        x = x.tolist()
+    if isinstance(x, float) and x.is_integer():
+        return int(x)
+    return x
+
+
+def result_cache_key(mods, first_budget_year, run_type):
+    '''
+    Hash everything that determines the results of a run: the reform as it
+    would be sent to the workers, the start year and number of budget
+    years, the taxcalc and dropq versions and the type of run. Returns
+    None if the reform is empty, since such runs are never submitted
+    '''
+    user_mods = package_up_arrays(mods, first_budget_year)
+    if not bool(user_mods):
+        return None
+    identity = {'user_mods': canonicalize(user_mods),
+                'first_budget_year': int(first_budget_year),
+                'num_budget_years': NUM_BUDGET_YEARS,
+                'taxcalc_version': taxcalc_version,
+                'dropq_version': dropq_version,
+                'run_type': run_type}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True)).hexdigest()
+
+
+_dispatch_pool = None
+_dispatch_pool_lock = threading.Lock()
+
+def get_dispatch_pool():
+    '''
+    Return the thread pool this process uses to fan out requests to the
+    workers. It is created on first use so that processes which never
+    dispatch jobs never start the threads
+    '''
+    global _dispatch_pool
+    with _dispatch_pool_lock:
+        if _dispatch_pool is None:
+            _dispatch_pool = ThreadPool(DROPQ_DISPATCH_POOL_SIZE)
+    return _dispatch_pool
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    '''
+    Return the requests Session this process uses for all worker
+    communication. Its connection pools keep connections to the dropq and
+    OG-USA hosts alive between submits and polls
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                  pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+class HostLoad(object):
+    '''
+    The recent load of the worker hosts, as seen by this process: a moving
+    average of the queue length each host reports when it accepts a job,
+    and of how long it takes to answer submissions and polls
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Hostnames mapped to dicts of qlength, latency, failed and updated
+        self.stats = {}
+
+    def _update(self, hostname, name, value, failed=False):
+        with self.lock:
+            stats = self.stats.setdefault(hostname, {'qlength': None,
+                                                     'latency': None,
+                                                     'failed': False,
+                                                     'updated': 0})
+            if self.is_stale(stats):
+                stats['qlength'] = stats['latency'] = None
+            if stats[name] is None:
+                stats[name] = value
+            else:
+                stats[name] += HOST_LOAD_SMOOTHING * (value - stats[name])
+            stats['failed'] = failed
+            stats['updated'] = time.time()
+
+    def is_stale(self, stats):
+        return time.time() - stats['updated'] > HOST_LOAD_TTL_IN_SECONDS
+
+    def record_submit(self, hostname, qlength, latency):
+        self._update(hostname, 'qlength', float(qlength))
+        self._update(hostname, 'latency', latency)
+
+    def record_failure(self, hostname):
+        self._update(hostname, 'latency', TIMEOUT_IN_SECONDS, failed=True)
+
+    def record_latency(self, hostname, latency):
+        self._update(hostname, 'latency', latency)
+
+    def load(self, hostname):
+        '''
+        The estimated number of jobs ahead of a new job on hostname.
+        Hosts not heard from recently count as idle, so they get tried
+        '''
+        with self.lock:
+            stats = self.stats.get(hostname)
+            if stats is None or self.is_stale(stats):
+                return 0.0
+            load = stats['qlength'] or 0.0
+            load += (stats['latency'] or 0.0) / LATENCY_PER_QUEUED_JOB
+            if stats['failed']:
+                load += FAILED_HOST_LOAD
+            return load
+
+    def assign(self, hostnames, num_jobs, offset=0):
+        '''
+        Pick a host for each of num_jobs jobs, every time the one with the
+        least load counting the jobs already given to it. Ties go to the
+        hosts in round robin order starting at offset. Returns the
+        indices of the hosts in hostnames
+        '''
+        num_hosts = len(hostnames)
+        heap = [(self.load(hostname), (idx - offset) % num_hosts, idx)
+                for idx, hostname in enumerate(hostnames)]
+        heapq.heapify(heap)
+        assigned = []
+        for _ in range(num_jobs):
+            load, rank, idx = heapq.heappop(heap)
+            assigned.append(idx)
+            heapq.heappush(heap, (load + 1, rank, idx))
+        return assigned
+
+HOST_LOAD = HostLoad()
+
+
+class CircuitBreaker(object):
+    '''
+    The health of one worker host. A closed breaker lets requests through.
+    After failure_threshold failures in a row it opens and the host is
+    left out, until reset_timeout seconds later it half-opens to let a
+    single trial request through. The trial closes the breaker again if
+    it succeeds and reopens it if it fails
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=HOST_FAILURE_THRESHOLD,
+                 reset_timeout=HOST_RESET_TIMEOUT_IN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+
+    def trial_due(self, now):
+        return now - self.opened_at >= self.reset_timeout
+
+    def available(self, now):
+        ''' Whether a request could be let through, without making one '''
+        return self.state == self.CLOSED or self.trial_due(now)
+
+    def allow(self, now):
+        ''' Whether to make a request, counting it as the trial if due '''
+        if self.state == self.CLOSED:
+            return True
+        if self.trial_due(now):
+            self.state = self.HALF_OPEN
+            self.opened_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self, now):
+        self.failures += 1
+        if (self.state == self.HALF_OPEN or
+                self.failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = now
+
+
+class HostHealth(object):
+    '''
+    The circuit breakers of the dropq and OG-USA worker hosts, shared by
+    everything in this process that talks to the workers. Hosts with an
+    open breaker are left out when choosing hosts for new jobs. Once the
+    web process starts it, unless HOST_HEARTBEAT_INTERVAL is 0, a
+    background thread probes the hosts being watched, so that dead hosts
+    are found and recovered hosts come back without a user request paying
+    for it
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.watched = set()
+        self.heartbeat = None
+
+    def breaker(self, hostname):
+        if hostname not in self.breakers:
+            self.breakers[hostname] = CircuitBreaker()
+        return self.breakers[hostname]
+
+    def available(self, hostnames):
+        '''
+        The hosts of hostnames that aren't left out, or all of them if every
+        one is, since a request to a possibly dead host beats no request
+        '''
+        now = time.time()
+        with self.lock:
+            hosts = [hostname for hostname in hostnames
+                     if self.breaker(hostname).available(now)]
+        return hosts or list(hostnames)
+
+    def allow(self, hostname):
+        with self.lock:
+            return self.breaker(hostname).allow(time.time())
+
+    def record_success(self, hostname):
+        with self.lock:
+            self.breaker(hostname).record_success()
+
+    def record_failure(self, hostname):
+        with self.lock:
+            self.breaker(hostname).record_failure(time.time())
+
+    def excluded(self):
+        ''' The hosts currently left out '''
+        now = time.time()
+        with self.lock:
+            return sorted(hostname for hostname, breaker in self.breakers.items()
+                          if not breaker.available(now))
+
+    def watch(self, hostnames):
+        ''' Add hostnames to the hosts probed by the heartbeat '''
+        with self.lock:
+            self.watched.update(hostname for hostname in hostnames if hostname)
+
+    def start(self):
+        ''' Start the heartbeat, unless it is off or already running '''
+        with self.lock:
+            if HOST_HEARTBEAT_INTERVAL > 0 and self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self.beat)
+                self.heartbeat.daemon = True
+                self.heartbeat.start()
+
+    def probe(self, hostname):
+        '''
+        Any answer short of a server error from hostname shows it is up
+        '''
+        try:
+            response = get_session().get("http://{hn}/".format(hn=hostname),
+                                         timeout=CONNECT_TIMEOUT_IN_SECONDS)
+        except RequestException:
+            self.record_failure(hostname)
+        else:
+            if response.status_code >= 500:
+                self.record_failure(hostname)
+            else:
+                self.record_success(hostname)
+
+    def beat(self):
+        while True:
+            time.sleep(HOST_HEARTBEAT_INTERVAL)
+            with self.lock:
+                hostnames = list(self.watched)
+            for hostname in hostnames:
+                self.probe(hostname)
+
+HOST_HEALTH = HostHealth()
+
+
+class HostAllocator(object):
+    '''
+    Hands out round robin positions over the worker hosts, shared by every
+    process through a WorkerNodesCounter row, the one whose
+    singleton_enforce is counter. Positions are reserved with a single
+    UPDATE ... RETURNING of the row on PostgreSQL, so that processes never
+    draw the same ones in a single round trip
+    '''
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def allocate(self, count):
+        '''
+        Reserve count consecutive positions and return the first of them.
+        Positions only grow, so take them modulo the number of hosts
+        '''
+        from .models import WorkerNodesCounter
+        position = self.advance(count)
+        if position is None:
+            try:
+                with transaction.atomic():
+                    WorkerNodesCounter.objects.create(
+                        singleton_enforce=self.counter)
+            except IntegrityError:
+                # Another process created the row first
+                pass
+            position = self.advance(count)
+        return position - count
+
+    def advance(self, count):
+        '''
+        Add count to the counter and return its new value, or None if its
+        row doesn't exist yet
+        '''
+        from .models import WorkerNodesCounter
+        if connection.vendor == 'postgresql':
+            quote = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE {table} SET {offset} = {offset} + %s "
+                    "WHERE {counter} = %s RETURNING {offset}".format(
+                        table=quote(WorkerNodesCounter._meta.db_table),
+                        offset=quote('current_offset'),
+                        counter=quote('singleton_enforce')),
+                    [count, self.counter])
+                row = cursor.fetchone()
+            return row[0] if row else None
+        # Without RETURNING the row is read back in the same transaction,
+        # which the UPDATE keeps it locked for
+        counters = WorkerNodesCounter.objects.filter(
+            singleton_enforce=self.counter)
+        with transaction.atomic():
+            if not counters.update(current_offset=F('current_offset') + count):
+                return None
+            return counters.values_list('current_offset', flat=True)[0]
+
+# The counter of the round robin over DROPQ_WORKERS, as before
+DROPQ_ALLOCATOR = HostAllocator(1)
+
+
+# Hostnames mapped to whether the worker answers the batched
+# dropq_query_results endpoint. Unknown hosts are tried once
+_batch_query_support = {}
+
+
 class DropqCompute(object):
 
     def __init__(self):
-        pass
+        HOST_HEALTH.watch(DROPQ_WORKERS)
 
     def remote_submit_job(self, theurl, data, timeout=TIMEOUT_IN_SECONDS):
-        response = requests.post(theurl, data=data, timeout=timeout)
+        response = get_session().post(theurl, data=data, timeout=timeout)
+        return response
+
+    def remote_register_job(self, theurl, data, timeout=TIMEOUT_IN_SECONDS):
+        response = get_session().post(theurl, data=data, timeout=timeout)
         return response
 
     def remote_results_ready(self, theurl, params):
-        job_response = requests.get(theurl, params=params)
+        job_response = get_session().get(theurl, params=params,
+                                         timeout=(CONNECT_TIMEOUT_IN_SECONDS,
+                                                  READ_TIMEOUT_IN_SECONDS))
+        return job_response
+
+    def remote_batch_results_ready(self, theurl, params):
+        job_response = get_session().get(theurl, params=params,
+                                         timeout=(CONNECT_TIMEOUT_IN_SECONDS,
+                                                  READ_TIMEOUT_IN_SECONDS))
         return job_response
 
     def remote_retrieve_results(self, theurl, params):
-        job_response = requests.get(theurl, params=params)
+        job_response = get_session().get(theurl, params=params,
+                                         timeout=(CONNECT_TIMEOUT_IN_SECONDS,
+                                                  READ_TIMEOUT_IN_SECONDS))
         return job_response
 
     def submit_dropq_calculation(self, mods, first_budget_year):
@@ -56,7 +472,7 @@ class DropqCompute(object):
     def submit_calculation(self, mods, first_budget_year, url_template,
                            start_budget_year=0):
         print "mods is ", mods
-        user_mods = package_up_vars(mods, first_budget_year)
+        user_mods = package_up_arrays(mods, first_budget_year)
         if not bool(user_mods):
             return False
         print "user_mods is ", user_mods
@@ -64,62 +480,128 @@ class DropqCompute(object):
         user_mods={first_budget_year:user_mods}
         years = list(range(start_budget_year,NUM_BUDGET_YEARS))
 
-        wnc, created = WorkerNodesCounter.objects.get_or_create(singleton_enforce=1)
-        dropq_worker_offset = wnc.current_offset
-        if dropq_worker_offset > len(DROPQ_WORKERS):
-            dropq_worker_offset = 0
-        wnc.current_offset = (dropq_worker_offset + NUM_BUDGET_YEARS) % len(DROPQ_WORKERS)
-        wnc.save()
-        hostnames = DROPQ_WORKERS[dropq_worker_offset: dropq_worker_offset + NUM_BUDGET_YEARS]
-        print "hostnames: ", hostnames
-        num_hosts = len(hostnames)
+        dropq_worker_offset = (DROPQ_ALLOCATOR.allocate(NUM_BUDGET_YEARS) %
+                               len(DROPQ_WORKERS))
+        hostnames = HOST_HEALTH.available(DROPQ_WORKERS)
+        # Each year starts on the least loaded healthy host, with the round
+        # robin offset breaking ties, and only moves on to the following
+        # hosts if that submission fails
+        host_idxs = HOST_LOAD.assign(hostnames, len(years),
+                                     dropq_worker_offset)
+        print "hostnames: ", [hostnames[idx] for idx in host_idxs]
         data = {}
         data['user_mods'] = json.dumps(user_mods)
-        job_ids = []
-        hostname_idx = 0
-        max_queue_length = 0
-        for y in years:
-            year_submitted = False
-            attempts = 0
-            while not year_submitted:
-                data['year'] = str(y)
-                theurl = url_template.format(hn=hostnames[hostname_idx])
-                try:
-                    response = self.remote_submit_job(theurl, data=data, timeout=TIMEOUT_IN_SECONDS)
-                    if response.status_code == 200:
-                        print "submitted: ", hostnames[hostname_idx]
-                        year_submitted = True
-                        response_d = response.json()
-                        job_ids.append((response_d['job_id'], hostnames[hostname_idx]))
-                        hostname_idx = (hostname_idx + 1) % num_hosts
-                        if response_d['qlength'] > max_queue_length:
-                            max_queue_length = response_d['qlength']
-                    else:
-                        print "FAILED: ", str(y), hostnames[hostname_idx]
-                        hostname_idx = (hostname_idx + 1) % num_hosts
-                        attempts += 1
-                except Timeout:
-                    print "Couldn't submit to: ", hostnames[hostname_idx]
-                    hostname_idx = (hostname_idx + 1) % num_hosts
-                    attempts += 1
-                except RequestException as re:
-                    print "Something unexpected happened: ", re
-                    hostname_idx = (hostname_idx + 1) % num_hosts
-                    attempts += 1
+
+        def submit(year_and_idx):
+            year, host_idx = year_and_idx
+            return self.submit_year(url_template, data, year, hostnames,
+                                    host_idx)
+
+        submissions = get_dispatch_pool().map(submit, zip(years, host_idxs))
+        job_ids = [(job_id, hostname) for job_id, hostname, _ in submissions]
+        max_queue_length = max([0] + [qlength for _, _, qlength in submissions])
+
+        return job_ids, max_queue_length
+
+    def submit_year(self, url_template, data, year, hostnames, hostname_idx):
+        '''
+        Submit the job for a single budget year, starting with the host at
+        hostname_idx and rotating through hostnames whenever a submission
+        fails. Returns the job ID, hostname and queue length reported by the
+        worker that accepted the job
+        '''
+        data = dict(data)
+        data['year'] = str(year)
+        num_hosts = len(hostnames)
+        attempts = 0
+        while True:
+            hostname = hostnames[hostname_idx]
+            # Unhealthy hosts are skipped, unless there is nothing else
+            if (not HOST_HEALTH.allow(hostname) and
+                    HOST_HEALTH.available(hostnames) != list(hostnames)):
+                print "Skipping unhealthy host: ", hostname
+                hostname_idx = (hostname_idx + 1) % num_hosts
+                attempts += 1
                 if attempts > MAX_ATTEMPTS_SUBMIT_JOB:
                     print "Exceeded max attempts. Bailing out."
                     raise IOError()
-
-        return job_ids, max_queue_length
+                continue
+            theurl = url_template.format(hn=hostname)
+            start = time.time()
+            try:
+                response = self.remote_submit_job(theurl, data=data, timeout=TIMEOUT_IN_SECONDS)
+                if response.status_code == 200:
+                    print "submitted: ", hostname
+                    response_d = response.json()
+                    HOST_LOAD.record_submit(hostname, response_d['qlength'],
+                                            time.time() - start)
+                    HOST_HEALTH.record_success(hostname)
+                    if DROPQ_CALLBACKS:
+                        self.register_callback(response_d['job_id'], hostname)
+                    return response_d['job_id'], hostname, response_d['qlength']
+                else:
+                    print "FAILED: ", str(year), hostname
+            except Timeout:
+                print "Couldn't submit to: ", hostname
+            except RequestException as re:
+                print "Something unexpected happened: ", re
+            HOST_LOAD.record_failure(hostname)
+            HOST_HEALTH.record_failure(hostname)
+            hostname_idx = (hostname_idx + 1) % num_hosts
+            attempts += 1
+            if attempts > MAX_ATTEMPTS_SUBMIT_JOB:
+                print "Exceeded max attempts. Bailing out."
+                raise IOError()
+
+    def register_callback(self, job_id, hostname):
+        '''
+        Ask the worker on hostname to call the dropq_finished view when
+        job_id is done. Returns whether the worker accepted. Failing to
+        register is not fatal, since the job is still found by polling
+        '''
+        reg_url = "http://{hn}/register_job".format(hn=hostname)
+        params = {
+            'job_id': job_id,
+            'callback': "http://{}/taxbrain/dropq_finished/".format(CALLBACK_HOSTNAME),
+        }
+        try:
+            response = self.remote_register_job(reg_url, data=params, timeout=TIMEOUT_IN_SECONDS)
+            if response.status_code == 200:
+                print "registered: ", hostname
+                return True
+            print "Couldn't register callback on: ", hostname
+        except RequestException as re:
+            print "Couldn't register callback on: ", hostname, re
+        return False
 
     def dropq_results_ready(self, job_ids):
-        jobs_done = [False] * len(job_ids)
+        '''
+        Return a list of booleans telling which of the (job_id, hostname)
+        pairs in job_ids are finished. The job IDs are grouped by hostname
+        and each host is queried concurrently, so a poll takes as long as
+        the slowest host. Raises JobFailError if any job has failed
+        '''
+        jobs_by_host = OrderedDict()
         for idx, id_hostname in enumerate(job_ids):
             id_, hostname = id_hostname
-            result_url = "http://{hn}/dropq_query_result".format(hn=hostname)
-            job_response = self.remote_results_ready(result_url, params={'job_id':id_})
-            if job_response.status_code == 200: # Valid response
-                rep = job_response.text
+            jobs_by_host.setdefault(hostname, []).append((idx, id_))
+
+        def query(hostname_and_jobs):
+            hostname, jobs = hostname_and_jobs
+            start = time.time()
+            try:
+                reps = self.host_results_ready(hostname, jobs)
+            except RequestException:
+                HOST_HEALTH.record_failure(hostname)
+                raise
+            HOST_HEALTH.record_success(hostname)
+            HOST_LOAD.record_latency(hostname, time.time() - start)
+            return reps
+
+        jobs_done = [False] * len(job_ids)
+        for host_reps in get_dispatch_pool().map(query, jobs_by_host.items()):
+            for idx, rep in host_reps:
+                id_, hostname = job_ids[idx]
                 if rep == 'YES':
                     jobs_done[idx] = True
                     print "got one!: ", id_
@@ -129,88 +611,102 @@ class DropqCompute(object):
 
         return jobs_done
 
-    def dropq_get_results(self, job_ids):
-        ans = []
-        for idx, id_hostname in enumerate(job_ids):
-            id_, hostname = id_hostname
-            result_url = "http://{hn}/dropq_get_result".format(hn=hostname)
-            job_response = self.remote_retrieve_results(result_url, params={'job_id':id_})
+    def host_results_ready(self, hostname, jobs):
+        '''
+        Query a single host for the status of jobs, a list of
+        (index, job_id) pairs. Workers that support it are asked about all
+        of their jobs at once through dropq_query_results, others get one
+        dropq_query_result request per job. Returns a list of
+        (index, status) pairs, where status is 'YES', 'NO' or 'FAIL'
+        '''
+        if len(jobs) > 1 and _batch_query_support.get(hostname, True):
+            result_url = "http://{hn}/dropq_query_results".format(hn=hostname)
+            ids = ",".join([id_ for idx, id_ in jobs])
+            job_response = self.remote_batch_results_ready(result_url,
+                                                           params={'job_ids':ids})
             if job_response.status_code == 200: # Valid response
-                ans.append(job_response.json())
-
-        mY_dec = {}
-        mX_dec = {}
-        df_dec = {}
-        pdf_dec = {}
-        cdf_dec = {}
-        mY_bin = {}
-        mX_bin = {}
-        df_bin = {}
-        pdf_bin = {}
-        cdf_bin = {}
-        fiscal_tots = {}
-        for result in ans:
-            mY_dec.update(result['mY_dec'])
-            mX_dec.update(result['mX_dec'])
-            df_dec.update(result['df_dec'])
-            pdf_dec.update(result['pdf_dec'])
-            cdf_dec.update(result['cdf_dec'])
-            mY_bin.update(result['mY_bin'])
-            mX_bin.update(result['mX_bin'])
-            df_bin.update(result['df_bin'])
-            pdf_bin.update(result['pdf_bin'])
-            cdf_bin.update(result['cdf_bin'])
-            fiscal_tots.update(result['fiscal_tots'])
-
+                _batch_query_support[hostname] = True
+                reps = job_response.json()
+                return [(idx, reps.get(id_)) for idx, id_ in jobs]
+            elif job_response.status_code == 404:
+                print "no batched queries on host: ", hostname
+                _batch_query_support[hostname] = False
+
+        reps = []
+        for idx, id_ in jobs:
+            result_url = "http://{hn}/dropq_query_result".format(hn=hostname)
+            job_response = self.remote_results_ready(result_url, params={'job_id':id_})
+            if job_response.status_code == 200: # Valid response
+                reps.append((idx, job_response.text))
+
+        return reps
+
+    def retrieve_year_result(self, job_id, hostname):
+        '''
+        Download the results of a single year's job, or return None if the
+        worker does not hand them over
+        '''
+        result_url = "http://{hn}/dropq_get_result".format(hn=hostname)
+        job_response = self.remote_retrieve_results(result_url, params={'job_id':job_id})
+        if job_response.status_code == 200: # Valid response
+            return job_response.json()
+        return None
+
+    def retrieve_results(self, job_ids):
+        '''
+        Download the results of the (job_id, hostname) pairs in job_ids
+        concurrently and yield each year's payload as soon as it arrives,
+        so callers can merge it and let the raw response go. Years whose
+        download does not succeed are skipped
+        '''
+        def retrieve(id_hostname):
+            id_, hostname = id_hostname
+            return self.retrieve_year_result(id_, hostname)
+
+        for result in get_dispatch_pool().imap_unordered(retrieve, job_ids):
+            if result is not None:
+                yield result
+
+    def merge_results(self, payloads, table_ids):
+        '''
+        Merge the tables named in table_ids from every year's payload
+        into one dictionary per table, incrementally as the years arrive
+        '''
+        results = {table_id: {} for table_id in table_ids}
+        versions = []
+        for result in payloads:
+            for table_id in table_ids:
+                results[table_id].update(result[table_id])
+            versions.append((result.get('taxcalc_version', None),
+                             result.get('dropq_version', None)))
 
         if ENFORCE_REMOTE_VERSION_CHECK:
-            versions = [r.get('taxcalc_version', None) for r in ans]
-            if not all([ver==taxcalc_version for ver in versions]):
+            if not all([tc_ver==taxcalc_version for tc_ver, _ in versions]):
                 msg ="Got different taxcalc versions from workers. Bailing out"
                 print msg
                 raise IOError(msg)
-            versions = [r.get('dropq_version', None) for r in ans]
-            if not all([same_version(ver, dropq_version) for ver in versions]):
+            if not all([same_version(dq_ver, dropq_version) for _, dq_ver in versions]):
                 msg ="Got different dropq versions from workers. Bailing out"
                 print msg
                 raise IOError(msg)
 
-        fiscal_tots = arrange_totals_by_row(fiscal_tots,
-                                            TAXCALC_RESULTS_TOTAL_ROW_KEYS)
+        return results
 
-        results = {'mY_dec': mY_dec, 'mX_dec': mX_dec, 'df_dec': df_dec,
-                'pdf_dec': pdf_dec, 'cdf_dec': cdf_dec, 'mY_bin': mY_bin,
-                'mX_bin': mX_bin, 'df_bin': df_bin, 'pdf_bin': pdf_bin,
-                'cdf_bin': cdf_bin, 'fiscal_tots': fiscal_tots}
+    def dropq_get_results(self, job_ids):
+        return self.dropq_merge_results(self.retrieve_results(job_ids))
 
+    def dropq_merge_results(self, payloads):
+        results = self.merge_results(payloads, TAXCALC_RESULTS_TABLE_IDS)
+        results['fiscal_tots'] = arrange_totals_by_row(results['fiscal_tots'],
+                                                       TAXCALC_RESULTS_TOTAL_ROW_KEYS)
         return results
 
     def elastic_get_results(self, job_ids):
-        ans = []
-        for idx, id_hostname in enumerate(job_ids):
-            id_, hostname = id_hostname
-            result_url = "http://{hn}/dropq_get_result".format(hn=hostname)
-            job_response = self.remote_retrieve_results(result_url, params={'job_id':id_})
-            if job_response.status_code == 200: # Valid response
-                ans.append(job_response.json())
-
-        elasticity_gdp = {}
-        for result in ans:
-            elasticity_gdp.update(result['elasticity_gdp'])
-
-
-        if ENFORCE_REMOTE_VERSION_CHECK:
-            versions = [r.get('taxcalc_version', None) for r in ans]
-            if not all([ver==taxcalc_version for ver in versions]):
-                msg ="Got different taxcalc versions from workers. Bailing out"
-                print msg
-                raise IOError(msg)
-            versions = [r.get('dropq_version', None) for r in ans]
-            if not all([same_version(ver, dropq_version) for ver in versions]):
-                msg ="Got different dropq versions from workers. Bailing out"
-                print msg
-                raise IOError(msg)
+        return self.elastic_merge_results(self.retrieve_results(job_ids))
 
+    def elastic_merge_results(self, payloads):
+        results = self.merge_results(payloads, ELASTIC_RESULTS_TABLE_IDS)
+        elasticity_gdp = results['elasticity_gdp']
         elasticity_gdp[u'gdp_elasticity_0'] = u'NA'
         elasticity_gdp = arrange_totals_by_row(elasticity_gdp,
                                             ELASTIC_RESULTS_TOTAL_ROW_KEYS)
@@ -224,6 +720,10 @@ class MockCompute(DropqCompute):
 
     __slots__ = ('count', 'num_times_to_wait')
 
+    # requests_mock patches requests globally, so calls made from the
+    # dispatch pool threads have to take turns
+    remote_lock = threading.RLock()
+
     def __init__(self, num_times_to_wait=0):
         self.count = 0
         # Number of times to respond 'No' before
@@ -231,15 +731,22 @@ class MockCompute(DropqCompute):
         self.num_times_to_wait = num_times_to_wait
 
     def remote_submit_job(self, theurl, data, timeout):
-        with requests_mock.Mocker() as mock:
+        with self.remote_lock, requests_mock.Mocker() as mock:
             resp = {'job_id': '424242', 'qlength':2}
             resp = json.dumps(resp)
             mock.register_uri('POST', '/dropq_start_job', text=resp)
             mock.register_uri('POST', '/elastic_gdp_start_job', text=resp)
             return DropqCompute.remote_submit_job(self, theurl, data, timeout)
 
+    def remote_register_job(self, theurl, data, timeout):
+        with self.remote_lock, requests_mock.Mocker() as mock:
+            resp = {'registered': data['job_id']}
+            resp = json.dumps(resp)
+            mock.register_uri('POST', '/register_job', text=resp)
+            return DropqCompute.remote_register_job(self, theurl, data, timeout)
+
     def remote_results_ready(self, theurl, params):
-        with requests_mock.Mocker() as mock:
+        with self.remote_lock, requests_mock.Mocker() as mock:
             if self.num_times_to_wait > 0:
                 mock.register_uri('GET', '/dropq_query_result', text='NO')
                 self.num_times_to_wait -= 1
@@ -247,24 +754,31 @@ class MockCompute(DropqCompute):
                 mock.register_uri('GET', '/dropq_query_result', text='YES')
             return DropqCompute.remote_results_ready(self, theurl, params)
 
+    def remote_batch_results_ready(self, theurl, params):
+        # Act like a worker without the batched endpoint so that the
+        # per-job responses above drive the tests
+        with self.remote_lock, requests_mock.Mocker() as mock:
+            mock.register_uri('GET', '/dropq_query_results', status_code=404)
+            return DropqCompute.remote_batch_results_ready(self, theurl, params)
+
     def remote_retrieve_results(self, theurl, params):
         mock_path = os.path.join(os.path.split(__file__)[0], "tests",
                                  "response_year_{0}.json")
-        with open(mock_path.format(self.count), 'r') as f:
-            text = f.read()
-        self.count += 1
-        with requests_mock.Mocker() as mock:
+        with self.remote_lock, requests_mock.Mocker() as mock:
+            with open(mock_path.format(self.count), 'r') as f:
+                text = f.read()
+            self.count += 1
             mock.register_uri('GET', '/dropq_get_result', text=text)
             return DropqCompute.remote_retrieve_results(self, theurl, params)
 
 class ElasticMockCompute(MockCompute):
 
     def remote_retrieve_results(self, theurl, params):
-        self.count += 1
         text = (u'{"elasticity_gdp": {"gdp_elasticity_1": "0.00310"}, '
                 '"dropq_version": "0.6.a96303", "taxcalc_version": '
                 '"0.6.10d462"}')
-        with requests_mock.Mocker() as mock:
+        with self.remote_lock, requests_mock.Mocker() as mock:
+            self.count += 1
             mock.register_uri('GET', '/dropq_get_result', text=text)
             return DropqCompute.remote_retrieve_results(self, theurl, params)
 
@@ -272,7 +786,7 @@ class ElasticMockCompute(MockCompute):
 class MockFailedCompute(MockCompute):
 
     def remote_results_ready(self, theurl, params):
-        with requests_mock.Mocker() as mock:
+        with self.remote_lock, requests_mock.Mocker() as mock:
             mock.register_uri('GET', '/dropq_query_result', text='FAIL')
             return DropqCompute.remote_results_ready(self, theurl, params)
 
@@ -292,7 +806,7 @@ class NodeDownCompute(MockCompute):
 
 
     def remote_submit_job(self, theurl, data, timeout):
-        with requests_mock.Mocker() as mock:
+        with self.remote_lock, requests_mock.Mocker() as mock:
             resp = {'job_id': '424242', 'qlength':2}
             resp = json.dumps(resp)
             if (self.switch % 2 == 0):
@@ -0,0 +1,163 @@
+"""
+Estimates of how long runs take on the workers.
+
+A run sent to the workers gets a RunTiming for every host its years went
+to, and the timings are completed with the seconds the run took once its
+results are saved. The time a new run is expected to take is the longest
+of its hosts' estimates. Each is an exponentially weighted moving average
+of the recent timings of the same run type on that host at a similar
+queue depth, padded with the average deviation from it. Without such
+timings the average over all hosts at that queue depth is used, and
+without those the (2 + queue depth) * JOB_PROC_TIME_IN_SECONDS rule of
+thumb.
+
+Timings are written to the database by whichever process saves the
+results, so every process reloads the latest ETA_SAMPLES of them at most
+every ETA_REFRESH_IN_SECONDS.
+"""
+import datetime
+import os
+import threading
+import time
+
+import pytz
+from django.contrib.contenttypes.models import ContentType
+
+from .models import RunTiming
+
+JOB_PROC_TIME_IN_SECONDS = int(os.environ.get('JOB_PROC_TIME', 30))
+ETA_SMOOTHING = float(os.environ.get('ETA_SMOOTHING', 0.2))
+ETA_SAMPLES = int(os.environ.get('ETA_SAMPLES', 500))
+ETA_REFRESH_IN_SECONDS = float(os.environ.get('ETA_REFRESH', 60.0))
+# Clients are asked to poll again after this fraction of the time left,
+# or of the time the run is overdue by, within the bounds below
+POLL_FRACTION = 0.25
+MIN_POLL_INTERVAL_IN_SECONDS = float(os.environ.get('MIN_POLL_INTERVAL', 2.0))
+MAX_POLL_INTERVAL_IN_SECONDS = float(os.environ.get('MAX_POLL_INTERVAL', 60.0))
+
+
+def utc_now():
+    return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+
+def depth_bucket(queue_depth):
+    """ Queue depths grouped by powers of two: 0, 1, 2-3, 4-7, ... """
+    return max(0, int(queue_depth)).bit_length()
+
+
+def default_seconds(queue_depth):
+    return (2 + queue_depth) * JOB_PROC_TIME_IN_SECONDS
+
+
+class RunTimeEstimator(object):
+    '''
+    Moving averages of how long runs take, with their average deviations,
+    by run type, host and queue depth bucket, and by run type and queue
+    depth bucket over all hosts
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Keys mapped to [mean, deviation] in seconds
+        self.stats = {}
+        self.loaded = None
+
+    def _add(self, key, seconds):
+        stats = self.stats.get(key)
+        if stats is None:
+            self.stats[key] = [seconds, 0.0]
+        else:
+            error = seconds - stats[0]
+            stats[0] += ETA_SMOOTHING * error
+            stats[1] += ETA_SMOOTHING * (abs(error) - stats[1])
+
+    def _add_timing(self, run_type, hostname, queue_depth, seconds):
+        bucket = depth_bucket(queue_depth)
+        self._add((run_type, hostname, bucket), seconds)
+        self._add((run_type, None, bucket), seconds)
+
+    def record(self, run_type, hostname, queue_depth, seconds):
+        with self.lock:
+            self._add_timing(run_type, hostname, queue_depth, seconds)
+
+    def refresh(self, force=False):
+        '''
+        Rebuild the averages from the latest timings in the database, if
+        they were last loaded more than ETA_REFRESH_IN_SECONDS ago
+        '''
+        if (not force and self.loaded is not None and
+                time.time() - self.loaded < ETA_REFRESH_IN_SECONDS):
+            return
+        timings = list(RunTiming.objects.filter(seconds__isnull=False)
+                       .order_by('-pk')
+                       .values_list('run_type', 'hostname', 'queue_depth',
+                                    'seconds')[:ETA_SAMPLES])
+        with self.lock:
+            self.stats = {}
+            for timing in reversed(timings):
+                self._add_timing(*timing)
+            self.loaded = time.time()
+
+    def host_seconds(self, run_type, hostname, queue_depth):
+        bucket = depth_bucket(queue_depth)
+        with self.lock:
+            stats = (self.stats.get((run_type, hostname, bucket)) or
+                     self.stats.get((run_type, None, bucket)))
+            if stats is None:
+                return default_seconds(queue_depth)
+            return stats[0] + stats[1]
+
+    def estimate(self, run_type, hostnames, queue_depth):
+        '''
+        The seconds a run of run_type sent to hostnames is expected to
+        take, given the longest queue the hosts reported
+        '''
+        self.refresh()
+        return max([self.host_seconds(run_type, hostname, queue_depth)
+                    for hostname in set(hostnames)] or
+                   [default_seconds(queue_depth)])
+
+RUN_TIMES = RunTimeEstimator()
+
+
+def start_timing(model, run_type, job_ids, queue_depth):
+    '''
+    Record that the years of model's run were sent to the workers as
+    job_ids, (job_id, hostname) pairs, and return the datetime the run is
+    expected to be done by
+    '''
+    now = utc_now()
+    hostnames = sorted(set(hostname for _, hostname in job_ids))
+    content_type = ContentType.objects.get_for_model(model)
+    RunTiming.objects.bulk_create([
+        RunTiming(content_type=content_type, object_id=model.pk,
+                  run_type=run_type, hostname=hostname,
+                  queue_depth=queue_depth, submitted=now)
+        for hostname in hostnames])
+    seconds = RUN_TIMES.estimate(run_type, hostnames, queue_depth)
+    return now + datetime.timedelta(seconds=seconds)
+
+
+def finish_timing(model):
+    ''' Complete the timings of model's run, now that it is done '''
+    now = utc_now()
+    content_type = ContentType.objects.get_for_model(model)
+    timings = RunTiming.objects.filter(content_type=content_type,
+                                       object_id=model.pk,
+                                       seconds__isnull=True)
+    for timing in timings:
+        timing.seconds = (now - timing.submitted).total_seconds()
+        timing.save(update_fields=['seconds'])
+        RUN_TIMES.record(timing.run_type, timing.hostname,
+                         timing.queue_depth, timing.seconds)
+
+
+def poll_interval(seconds_left):
+    '''
+    The seconds a client waiting on a run should wait before asking
+    again: long while the run has a long way to go, short around the time
+    it is expected, and backing off again the longer it is overdue
+    '''
+    interval = abs(seconds_left) * POLL_FRACTION
+    return round(min(max(interval, MIN_POLL_INTERVAL_IN_SECONDS),
+                     MAX_POLL_INTERVAL_IN_SECONDS), 1)
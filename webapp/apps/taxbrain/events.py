@@ -0,0 +1,115 @@
+"""
+Notifications of changes in the progress of runs.
+
+Whatever changes a run's progress, a finished year, its results being
+saved or a failure, publishes on the run's channel, and requests waiting
+on that channel wake up. Waiters in the same process are woken directly.
+With a Redis server, events are also published there, and every process
+listens for them on a background thread, so that the runs collected by a
+collect_results command or a callback to another process wake the
+requests waiting here too. Without one, waiters only miss the events of
+other processes, and find out by reading the database again.
+"""
+import os
+import threading
+import time
+
+EVENTS_REDIS_URL = os.environ.get('REDISGREEN_URL', '')
+# Seconds between attempts to listen to Redis again after losing it
+EVENTS_RETRY_IN_SECONDS = 5.0
+CHANNEL_PREFIX = 'run:'
+
+
+def run_channel(model):
+    """
+    The channel of the run of model, any of the models with a tax_result.
+    Named after the concrete model, since instances loaded with only() or
+    defer() belong to a class of their own
+    """
+    return "{0}{1}:{2}".format(CHANNEL_PREFIX,
+                               model._meta.concrete_model._meta.model_name,
+                               model.pk)
+
+
+class EventBus(object):
+    '''
+    Wakes the requests waiting on a channel when an event is published on
+    it. Waiters register an Event with listen before reading the state
+    they are waiting on, so that no event is lost in between, and are
+    forgotten once woken
+    '''
+
+    def __init__(self, redis_url=EVENTS_REDIS_URL):
+        self.lock = threading.Lock()
+        # Channels mapped to the Events of the requests waiting on them
+        self.waiting = {}
+        self.redis = None
+        self.listener = None
+        if redis_url:
+            try:
+                import redis
+                self.redis = redis.StrictRedis.from_url(redis_url)
+                self.redis_error = redis.RedisError
+            except ImportError:
+                print "redis is not installed, keeping run events per process"
+
+    def listen(self, channel):
+        ''' Register a waiter on channel, and return its Event '''
+        self.start()
+        event = threading.Event()
+        with self.lock:
+            self.waiting.setdefault(channel, set()).add(event)
+        return event
+
+    def forget(self, channel, event):
+        with self.lock:
+            events = self.waiting.get(channel)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self.waiting[channel]
+
+    def wake(self, channel):
+        ''' Wake the waiters on channel in this process '''
+        with self.lock:
+            events = self.waiting.pop(channel, ())
+        for event in events:
+            event.set()
+
+    def publish(self, channel):
+        self.wake(channel)
+        if self.redis is not None:
+            try:
+                self.redis.publish(channel, '')
+            except self.redis_error as re:
+                print "Couldn't publish run event to redis: ", re
+
+    def start(self):
+        ''' Start listening to Redis, if there is a server to listen to '''
+        if self.redis is None or self.listener is not None:
+            return
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.relay)
+                self.listener.daemon = True
+                self.listener.start()
+
+    def relay(self):
+        ''' Wake the waiters on the channels of the events from Redis '''
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(CHANNEL_PREFIX + '*')
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.wake(message['channel'])
+            except self.redis_error as re:
+                print "Lost redis run events: ", re
+            time.sleep(EVENTS_RETRY_IN_SECONDS)
+
+EVENT_BUS = EventBus()
+
+
+def publish_progress(model):
+    """ Wake the requests waiting on the progress of model's run """
+    EVENT_BUS.publish(run_channel(model))
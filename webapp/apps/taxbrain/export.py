@@ -0,0 +1,118 @@
+"""
+Bulk export of the results of many runs.
+
+The export is a tar archive with one directory per results table.
+Each directory holds CSV parts with the rows of up to EXPORT_BATCH_SIZE
+runs, every row starting with the OutputUrl pk of its run, so that the
+archive reads as a partitioned table:
+
+    fiscal_tots/part-00000.csv    run_id, year, row, value
+    mX_dec/part-00000.csv         run_id, year, row, <column labels>
+    ...
+
+The runs of a part are read with one query for their inputs and one for
+their ResultTables, and only one part is held in memory at a time. The
+archive isn't compressed here, GZipMiddleware compresses the response for
+the clients that accept it.
+"""
+import csv
+import os
+import tarfile
+import time
+from cStringIO import StringIO
+
+from .models import TaxSaveInputs, OutputUrl
+from .helpers import CSV_TABLES
+from .columnar import load_tax_results
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 50))
+EXPORT_MAX_RUNS = int(os.environ.get('EXPORT_MAX_RUNS', 5000))
+FISCAL_TOTALS = ['payroll_tax', 'combined_tax', 'ind_tax']
+EXPORT_TABLE_IDS = ['fiscal_tots'] + [table_id for table_id, _, _ in CSV_TABLES]
+
+
+class ArchiveBuffer(object):
+    """ Collects the bytes tarfile writes until they are sent """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        data = "".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def batch_results(url_pks):
+    """
+    The (url pk, first year, results) of the runs of url_pks that have
+    results, in the order of url_pks
+    """
+    unique_inputs = dict(OutputUrl.objects.filter(pk__in=url_pks)
+                         .values_list('pk', 'unique_inputs_id'))
+    models = list(TaxSaveInputs.objects
+                  .filter(pk__in=set(unique_inputs.values()),
+                          tax_result__isnull=False)
+                  .only('tax_result', 'first_year'))
+    first_years = {model.pk: model.first_year for model in models}
+    results = load_tax_results(models, EXPORT_TABLE_IDS) if models else {}
+    return [(pk, first_years[unique_inputs[pk]], results[unique_inputs[pk]])
+            for pk in url_pks if unique_inputs.get(pk) in results]
+
+
+def table_header(table_id):
+    """ The CSV header of the parts of one table """
+    if table_id == 'fiscal_tots':
+        return ['run_id', 'year', 'row', 'value']
+    for csv_table_id, col_labels, _ in CSV_TABLES:
+        if csv_table_id == table_id:
+            return ['run_id', 'year', 'row'] + list(col_labels)
+
+
+def table_rows(table_id, results, first_year):
+    """ Yield the [year, row, values...] rows of one table of a run """
+    ft = results.get('fiscal_tots', {})
+    num_years = len(ft.get('ind_tax', []))
+    if table_id == 'fiscal_tots':
+        for total in FISCAL_TOTALS:
+            for i, value in enumerate(ft.get(total, [])):
+                yield [first_year + i, total, value]
+        return
+
+    table = results.get(table_id, {})
+    if not table:
+        return
+    row_keys = [keys for csv_table_id, _, keys in CSV_TABLES
+                if csv_table_id == table_id][0]
+    for count in range(num_years):
+        for row in row_keys:
+            yield [first_year + count, row] + table[row + "_" + str(count)]
+
+
+def archive_chunks(url_pks, batch_size=EXPORT_BATCH_SIZE):
+    """ Yield the bytes of the export archive of the runs of url_pks """
+    buf = ArchiveBuffer()
+    tar = tarfile.open(mode='w|', fileobj=buf)
+    for part, start in enumerate(range(0, len(url_pks), batch_size)):
+        runs = batch_results(url_pks[start:start + batch_size])
+        for table_id in EXPORT_TABLE_IDS:
+            out = StringIO()
+            writer = csv.writer(out)
+            writer.writerow(table_header(table_id))
+            for url_pk, first_year, results in runs:
+                for row in table_rows(table_id, results, first_year):
+                    writer.writerow([url_pk] + row)
+            data = out.getvalue()
+            info = tarfile.TarInfo("{0}/part-{1:05d}.csv".format(table_id,
+                                                                 part))
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, StringIO(data))
+            chunk = buf.drain()
+            if chunk:
+                yield chunk
+    tar.close()
+    yield buf.drain()
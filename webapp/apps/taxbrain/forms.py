@@ -1,3 +1,7 @@
+import copy
+import threading
+
+import numpy as np
 from django import forms
 from django.forms import ModelForm
 from django.utils.translation import ugettext_lazy as _
@@ -15,21 +19,132 @@ def bool_like(x):
 TAXCALC_DEFAULTS_2016 = default_policy(2016)
 
 
+class FieldValidation(object):
+    """
+    The min and max checks taxcalc's param definitions put on one column
+    field, with the data they compare against resolved in advance. Each
+    check is a tuple of the operator ('max' or 'min'), the source name and
+    either the ID of the other field whose values it compares against, or
+    None when the bounds are fixed
+    """
+    def __init__(self, field_id, defaults):
+        self.field_id = field_id
+        self.defaults = defaults
+        self.checks = []
+
+    def add_check(self, op, comp_key, param_id, col, default_params):
+        base_col = default_params[param_id].col_fields[col]
+        if is_number(comp_key):
+            check = (op, "the static value", None, [comp_key])
+        elif comp_key == 'default':
+            check = (op, "this field's default", None, list(base_col.values))
+        elif comp_key in default_params:
+            other_param = default_params[comp_key]
+            other_col = other_param.col_fields[col]
+            check = (op, other_param.name, other_col.id, list(other_col.values))
+        else:
+            raise ValueError('Unknown comp keyword "{0}"'.format(comp_key))
+
+        if len(check[3]) < 1:
+            raise ValueError('No comparison data found for kw'.format(comp_key))
+        self.checks.append(check)
+        return check
+
+
+def pad_to(values, required_length):
+    """
+    Expand values to required_length by repeating the final value
+
+    @todo: CPI inflate the final value to fill instead of simply repeating
+    """
+    len_diff = required_length - len(values)
+    if len_diff > 0:
+        return values + [values[-1]] * len_diff
+    return values[:required_length]
+
+
+def violations(op, values, bounds):
+    """ Indices of the values above (op 'max') or below (op 'min') bounds """
+    values = np.array(values, dtype=np.float64)
+    bounds = np.array(bounds, dtype=np.float64)
+    if op == 'max':
+        return np.flatnonzero(values > bounds)
+    return np.flatnonzero(values < bounds)
+
+
+class ValidationPlan(object):
+    """
+    The taxcalc validations of all fields for one start year, built once.
+    Submitting a value for a field only needs the checks of that field and
+    of the fields compared against it; the other checks see nothing but
+    defaults, so whether they fail is known in advance
+    """
+    def __init__(self, default_params):
+        self.validations = []
+        self.dependents = {}
+        self.default_failures = set()
+
+        for param_id, param in default_params.iteritems():
+            if param.coming_soon or param.hidden:
+                continue
+
+            if param.max is None and param.min is None:
+                continue
+
+            for col, col_field in enumerate(param.col_fields):
+                validation = FieldValidation(col_field.id,
+                                             list(col_field.values))
+                idx = len(self.validations)
+                self.validations.append(validation)
+                self.dependents.setdefault(col_field.id, set()).add(idx)
+
+                for op, comp_key in (('max', param.max), ('min', param.min)):
+                    if comp_key is None:
+                        continue
+                    __, __, other_id, bounds = validation.add_check(
+                        op, comp_key, param_id, col, default_params)
+                    if other_id is not None:
+                        self.dependents.setdefault(other_id, set()).add(idx)
+                    bounds = pad_to(bounds, len(validation.defaults))
+                    if len(violations(op, validation.defaults, bounds)):
+                        self.default_failures.add(idx)
+
+    def to_run(self, submitted_ids):
+        """
+        The field validations that can fail when the fields in submitted_ids
+        have values, in the order they were defined
+        """
+        indices = set(self.default_failures)
+        for field_id in submitted_ids:
+            indices.update(self.dependents.get(field_id, ()))
+        return [self.validations[idx] for idx in sorted(indices)]
+
+
+_validation_plans = {}
+_validation_plans_lock = threading.Lock()
+
+def validation_plan(start_year):
+    """ The ValidationPlan for start_year, built once per process """
+    with _validation_plans_lock:
+        if start_year not in _validation_plans:
+            _validation_plans[start_year] = ValidationPlan(default_policy(start_year))
+        return _validation_plans[start_year]
+
+
+_year_base_fields = {}
+_year_base_fields_lock = threading.Lock()
+
+
 class PersonalExemptionForm(ModelForm):
 
     def __init__(self, first_year, *args, **kwargs):
         self._first_year = int(first_year)
-        self._default_params = default_policy(self._first_year)
         # Defaults are set in the Meta, but we need to swap
-        # those outs here in the init because the user may
-        # have chosen a different start year
-        all_defaults = []
-        for param in self._default_params.values():
-            for field in param.col_fields:
-                all_defaults.append((field.id, field.default_value))
+        # those outs here because the user may have chosen a
+        # different start year
+        self.base_fields = self.year_base_fields(self._first_year)
 
-        for _id, default in all_defaults:
-            self._meta.widgets[_id].attrs['placeholder'] = default
+        super(PersonalExemptionForm, self).__init__(*args, **kwargs)
 
         # If a stored instance is passed,
         # set CPI flags based on the values in this instance
@@ -37,66 +152,28 @@ class PersonalExemptionForm(ModelForm):
             instance = kwargs['instance']
             cpi_flags = [attr for attr in dir(instance) if attr.endswith('_cpi')]
             for flag in cpi_flags:
-                if getattr(instance, flag) is not None and flag in self._meta.widgets:
-                    self._meta.widgets[flag].attrs['placeholder'] = getattr(instance, flag)
-
-        super(PersonalExemptionForm, self).__init__(*args, **kwargs)
+                if getattr(instance, flag) is not None and flag in self.fields:
+                    self.fields[flag].widget.attrs['placeholder'] = getattr(instance, flag)
 
-    def get_comp_data(self, comp_key, param_id, col, required_length):
+    @classmethod
+    def year_base_fields(cls, first_year):
         """
-        Get the data necessary for a min/max validation comparison, given:
-            param_id - The webapp-internal TC parameter ID
-            col - The column number for the param
-            comp_key - a key that is either:
-               * a static value
-               * the word 'default' - we should use the field's defaults
-               * the name of another param - we should use that param's
-                 corresponding column field. If values have been submitted for
-                 it, use them. Otherwise use its defaults
-             required_len - The number of values we need to compare against
-
-        After finding the proper data, expand it to the required_length by
-        repeating the final value.
-
-        @todo: CPI inflate the final value to fill instead of simply repeating
+        The form's fields with placeholders showing the defaults for
+        first_year. They are built once per process for each year and never
+        changed afterwards: every form gets its own copy of them when it is
+        constructed, as with the class' base_fields
         """
-
-        base_param = self._default_params[param_id]
-        base_col = base_param.col_fields[col]
-
-        if is_number(comp_key):
-            comp_data = [comp_key]
-            source = "the static value"
-        elif comp_key == 'default':
-            comp_data = base_col.values
-            source = "this field's default"
-        elif comp_key in self._default_params:
-            other_param = self._default_params[comp_key]
-            other_col = other_param.col_fields[col]
-            other_values = None
-
-            if other_col.id in self.cleaned_data:
-                other_values_raw = self.cleaned_data[other_col.id]
-                other_values = string_to_float_array(other_values_raw)
-
-            if other_values:
-                comp_data = other_values
-                source = other_param.name + "'s value"
-            else:
-                other_defaults = other_col.values
-                comp_data = other_defaults
-                source = other_param.name + "'s default"
-        else:
-            raise ValueError('Unknown comp keyword "{0}"'.format(comp_key))
-
-        if len(comp_data) < 1:
-            raise ValueError('No comparison data found for kw'.format(comp_key))
-
-        len_diff = required_length - len(comp_data)
-        if len_diff > 0:
-            comp_data += [comp_data[-1]] * len_diff
-
-        return {'source': source, 'comp_data': comp_data}
+        key = (cls, first_year)
+        with _year_base_fields_lock:
+            if key not in _year_base_fields:
+                base_fields = copy.deepcopy(cls.base_fields)
+                for param in default_policy(first_year).values():
+                    for field in param.col_fields:
+                        if field.id in base_fields:
+                            widget = base_fields[field.id].widget
+                            widget.attrs['placeholder'] = field.default_value
+                _year_base_fields[key] = base_fields
+            return _year_base_fields[key]
 
     def clean(self):
         """
@@ -136,65 +213,60 @@ class PersonalExemptionForm(ModelForm):
         are detected.
         """
 
-        for param_id, param in self._default_params.iteritems():
-            if param.coming_soon or param.hidden:
-                continue
+        submitted = {}
+        for field_id in self.cleaned_data:
+            raw = self.cleaned_data[field_id]
+            if is_string(raw) and raw:
+                submitted[field_id] = raw
 
-            if param.max is None and param.min is None:
+        plan = validation_plan(self._first_year)
+        for validation in plan.to_run(submitted):
+            col_id = validation.field_id
+            if col_id not in self.cleaned_data:
                 continue
+            submitted_col_values = string_to_float_array(self.cleaned_data[col_id])
 
-            for col, col_field in enumerate(param.col_fields):
-                submitted_col_values_raw = self.cleaned_data[col_field.id]
-                submitted_col_values = string_to_float_array(submitted_col_values_raw)
-                default_col_values = col_field.values
-
-                # If we change a different field which this field relies on for
-                # validation, we must ensure this is validated even if unchanged
-                # from defaults
-                if submitted_col_values:
-                    col_values = submitted_col_values
-                else:
-                    col_values = default_col_values
-
-                if param.max is not None:
-                    comp = self.get_comp_data(param.max, param_id, col, len(col_values))
-                    source = comp['source']
-                    maxes = comp['comp_data']
-
-                    for i, value in enumerate(col_values):
-                        if value > maxes[i]:
-                            if len(col_values) == 1:
-                                self.add_error(col_field.id,
-                                               u"Must be \u2264 {0} of {1}".
-                                               format(source, maxes[i]))
-                            else:
-                                self.add_error(col_field.id,
-                                               u"{0} value must be \u2264 \
-                                               {1}'s {0} value of {2}".format(
-                                                   int_to_nth(i + 1),
-                                                   source, maxes[i]))
-
-                if param.min is not None:
-                    comp = self.get_comp_data(param.min, param_id, col, len(col_values))
-                    source = comp['source']
-                    mins = comp['comp_data']
-
-                    for i, value in enumerate(col_values):
-                        if value < mins[i]:
-                            if len(col_values) == 1:
-                                self.add_error(col_field.id,
-                                               u"Must be \u2265 {0} of {1}".
-                                               format(source, mins[i]))
-                            else:
-                                self.add_error(col_field.id,
-                                               u"{0} value must be \u2265 \
-                                               {1}'s {0} value of {2}".format(
-                                                   int_to_nth(i + 1),
-                                                   source, mins[i]))
+            # If we change a different field which this field relies on for
+            # validation, we must ensure this is validated even if unchanged
+            # from defaults
+            if submitted_col_values:
+                col_values = submitted_col_values
+            else:
+                col_values = validation.defaults
+
+            for op, name, other_id, bounds in validation.checks:
+                source = name
+                if other_id is not None:
+                    other_values = None
+                    if other_id in self.cleaned_data:
+                        other_values = string_to_float_array(self.cleaned_data[other_id])
+                    if other_values:
+                        bounds = other_values
+                        source = name + "'s value"
+                    else:
+                        source = name + "'s default"
+                bounds = pad_to(bounds, len(col_values))
+
+                for i in violations(op, col_values, bounds):
+                    self.add_taxcalc_error(col_id, op, i, len(col_values),
+                                           source, bounds[i])
+
+    def add_taxcalc_error(self, col_id, op, i, num_values, source, bound):
+        """ Add the error for the i-th value of col_id breaking a min/max """
+        sign = u"\u2264" if op == 'max' else u"\u2265"
+        if num_values == 1:
+            self.add_error(col_id, u"Must be {0} {1} of {2}".
+                           format(sign, source, bound))
+        else:
+            self.add_error(col_id, u"{0} value must be {1} \
+                                               {2}'s {0} value of {3}".format(
+                                                   int_to_nth(i + 1), sign,
+                                                   source, bound))
 
     class Meta:
         model = TaxSaveInputs
-        exclude = ['creation_date']
+        exclude = ['creation_date', 'job_failed', 'result_cache_key',
+                   'tables_json', 'tax_result']
         widgets = {}
         labels = {}
 
@@ -1,6 +1,10 @@
 from collections import namedtuple
+import copy
+import functools
 import numbers
 import os
+import threading
+import numpy as np
 import pandas as pd
 import dropq
 import sys
@@ -65,6 +69,15 @@ def arrange_totals_by_row(tots, keys):
         out[key] = vals
     return out
 
+def denormalize(x):
+    ans = ["#".join([i[0],i[1]]) for i in x]
+    ans = [str(x) for x in ans]
+    return ans
+
+def normalize(x):
+    ans = [i.split('#') for i in x]
+    return ans
+
 def round_gt_one_to_nearest_int(values):
     ''' round every value to the nearest integer '''
     def round_gt_one(x):
@@ -80,6 +93,31 @@ def round_gt_one_to_nearest_int(values):
     return rounded
 
 
+tcversion_info = taxcalc._version.get_versions()
+taxcalc_version = ".".join([tcversion_info['version'], tcversion_info['full'][:6]])
+
+_defaults_cache = {}
+_defaults_cache_lock = threading.RLock()
+
+def cache_defaults(func):
+    '''
+    Memoize a function building default parameter data, per process, on its
+    arguments and the taxcalc version. The first call builds the data and
+    every call returns its own deep copy, so callers are free to mutate it
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__module__, func.__name__, args,
+               tuple(sorted(kwargs.items())), taxcalc_version)
+        with _defaults_cache_lock:
+            if key not in _defaults_cache:
+                _defaults_cache[key] = func(*args, **kwargs)
+            defaults = _defaults_cache[key]
+        return copy.deepcopy(defaults)
+    return wrapper
+
+
+@cache_defaults
 def default_taxcalc_data(cls, start_year, metadata=False):
     ''' Call the default data function on the given class for the given
         start year with meatadata flag
@@ -98,9 +136,6 @@ def default_taxcalc_data(cls, start_year, metadata=False):
 # Prepare user params to send to DropQ/Taxcalc
 #
 
-tcversion_info = taxcalc._version.get_versions()
-taxcalc_version = ".".join([tcversion_info['version'], tcversion_info['full'][:6]])
-
 TAXCALC_COMING_SOON_FIELDS = [
     '_Dividend_rt1', '_Dividend_thd1',
     '_Dividend_rt2', '_Dividend_thd2',
@@ -265,6 +300,30 @@ def expand_list(x, num_years):
         return expand_1D(x, num_years)
 
 
+_indexing_rates_cache = {}
+_indexing_rates_lock = threading.Lock()
+
+def indexing_rates(first_budget_year, num_years):
+    """
+    The CPI indexing rates for num_years budget years starting at
+    first_budget_year, as a read-only array. They are computed from a
+    taxcalc Policy once per process for each first_budget_year and
+    num_years
+    """
+    key = (int(first_budget_year), int(num_years))
+    with _indexing_rates_lock:
+        if key not in _indexing_rates_cache:
+            pp = Policy(start_year=2013)
+            pp.set_year(first_budget_year)
+            irates = pp.indexing_rates_for_update(param_name='II_brk2',
+                                                  calyear=first_budget_year,
+                                                  num_years_to_expand=num_years)
+            irates = np.array(irates, dtype=np.float64)
+            irates.flags.writeable = False
+            _indexing_rates_cache[key] = irates
+        return _indexing_rates_cache[key]
+
+
 def propagate_user_list(x, defaults, cpi, first_budget_year):
     """
     Dispatch to either expand_1D or expand2D depending on the dimension of x
@@ -294,28 +353,22 @@ def propagate_user_list(x, defaults, cpi, first_budget_year):
 
     is_rate = any([ i < 1.0 for i in x])
 
-    pp = Policy(start_year=2013)
-    pp.set_year(first_budget_year)
-    # irates are rates for 2015, 2016, and 2017
+    ans = [defaults[i] if x[i] == '*' else x[i] for i in range(len(x))]
+    num_to_fill = num_years - len(x)
+    if num_to_fill <= 0:
+        return ans
+
     if cpi:
-        irates = pp.indexing_rates_for_update(param_name='II_brk2',
-                                              calyear=first_budget_year,
-                                              num_years_to_expand=num_years)
+        irates = indexing_rates(first_budget_year, num_years)
     else:
-        irates = [0.0] * num_years
-
-    last_val = x[-1]
-    ans = [None] * num_years
-    for i in range(num_years):
-        if i < len(x):
-            if x[i] == '*':
-                ans[i] = defaults[i]
-            else:
-                ans[i] = x[i]
-        else:
-            newval = ans[i-1] * (1.0 + irates[i-1])
-            ans[i] = newval if is_rate else int(newval)
+        irates = np.zeros(num_years)
 
+    # Values after the last user value grow at the rates of the years
+    # before them. Dollar amounts are truncated to ints at every step
+    growth = (1.0 + irates[len(x) - 1:num_years - 1]).tolist()
+    for factor in growth:
+        newval = ans[-1] * factor
+        ans.append(newval if is_rate else int(newval))
 
     return ans
 
@@ -497,6 +550,197 @@ def package_up_vars(user_values, first_budget_year):
     return ans
 
 
+_param_arrays_cache = {}
+_param_arrays_lock = threading.Lock()
+
+def default_param_arrays(first_budget_year):
+    """
+    The defaults package_up_arrays works from: a dict of every parameter's
+    default values as a read-only (years x columns) float array, with NaN
+    for years that have no value, and whether the parameter is 2D; and a
+    dict of every parameter's default CPI flag. Built once per process for
+    each first_budget_year
+    """
+    key = (int(first_budget_year), taxcalc_version)
+    with _param_arrays_lock:
+        if key not in _param_arrays_cache:
+            dd = default_taxcalc_data(taxcalc.policy.Policy,
+                                      start_year=first_budget_year)
+            dd.update(default_taxcalc_data(taxcalc.growth.Growth,
+                                           start_year=first_budget_year))
+            dd.update(default_taxcalc_data(taxcalc.Behavior,
+                                           start_year=first_budget_year))
+            dd.update({"elastic_gdp":[0.54]})
+            dd_meta = {"elastic_gdp":{'values':[0.54], 'cpi_inflated':False}}
+            for cls in (taxcalc.Behavior, taxcalc.policy.Policy,
+                        taxcalc.growth.Growth):
+                dd_meta.update(default_taxcalc_data(cls,
+                                                    start_year=first_budget_year,
+                                                    metadata=True))
+
+            arrays = {}
+            for param, values in dd.items():
+                arr = np.array(values, dtype=np.float64)
+                is_2d = arr.ndim == 2
+                if not is_2d:
+                    arr = arr.reshape(-1, 1)
+                arr.flags.writeable = False
+                arrays[param] = (arr, is_2d)
+            cpi_flags = {param: attrs.get('cpi_inflated', False)
+                         for param, attrs in dd_meta.items()}
+            _param_arrays_cache[key] = (arrays, cpi_flags)
+        return _param_arrays_cache[key]
+
+
+def propagate_columns(user, wildcards, defaults, cpi, first_budget_year):
+    """
+    Column-wise version of propagate_user_list
+
+    Parameters:
+    -----------
+    user: (years x columns) float array of user values, NaN for blanks
+
+    wildcards: bool array shaped like user, True where the user entered '*'
+
+    defaults: (years x columns) float array of default values
+
+    cpi: Bool
+
+    first_budget_year: int
+
+    Returns:
+    --------
+    float array with max(len(defaults), len(user)) rows. Wildcards are
+    replaced by defaults and the years after the last user value are
+    inflated from it, truncating dollar amounts at every step
+    """
+    num_user = len(user)
+    num_years = max(len(defaults), num_user)
+    if len(defaults) < num_user:
+        padding = np.full((num_user - len(defaults), defaults.shape[1]), np.nan)
+        defaults = np.vstack([defaults, padding])
+
+    ans = np.empty((num_years, user.shape[1]))
+    ans[:num_user] = np.where(wildcards, defaults[:num_user], user)
+    if num_years == num_user:
+        return ans
+
+    if cpi:
+        irates = indexing_rates(first_budget_year, num_years)
+    else:
+        irates = np.zeros(num_years)
+    growth = 1.0 + irates[num_user - 1:num_years - 1]
+
+    # A column holds rates if any of its user values is below one
+    with np.errstate(invalid='ignore'):
+        is_rate = ((user < 1.0) & ~wildcards).any(axis=0)
+    for i in range(num_user, num_years):
+        newval = ans[i - 1] * growth[i - num_user]
+        ans[i] = np.where(is_rate, newval, np.trunc(newval))
+    return ans
+
+
+def user_array(values):
+    """
+    The (years x 1) float array of a list of user values, NaN for blanks,
+    and the matching array flagging the '*' wildcards
+    """
+    wildcards = np.array([v == '*' for v in values], dtype=bool)
+    arr = np.array([np.nan if (v == '*' or v is None) else v
+                    for v in values], dtype=np.float64)
+    return arr.reshape(-1, 1), wildcards.reshape(-1, 1)
+
+
+def array_to_list(arr, is_2d):
+    """
+    Turn a (years x columns) float array back into the nested lists dropq
+    expects, with None for NaN and ints for whole numbers above one
+    """
+    def to_value(x):
+        if np.isnan(x):
+            return None
+        elif x > 1.0 and x.is_integer():
+            return int(x)
+        return x
+
+    rows = [[to_value(x) for x in row] for row in arr.tolist()]
+    if is_2d:
+        return rows
+    return [row[0] for row in rows]
+
+
+def package_up_arrays(user_values, first_budget_year):
+    """
+    Array-backed equivalent of package_up_vars, producing the same dropq
+    user_mods from the cached default_param_arrays. Columns of 2D
+    parameters entered separately (the _0 .. _3 fields) are propagated
+    together. Unlike package_up_vars, user_values is left untouched
+    """
+    arrays, cpi_flags = default_param_arrays(first_budget_year)
+    user_values = {k: v for k, v in user_values.items()
+                   if leave_name_in(k, v, arrays)}
+
+    def discover_cpi_flag(param):
+        cpi_flag = user_values.get(param + "_cpi", None)
+        if cpi_flag is None:
+            cpi_flag = user_values.get("_" + param + "_cpi", None)
+        if cpi_flag is None:
+            cpi_flag = cpi_flags[param]
+        return cpi_flag
+
+    def param_name(k):
+        return k if k in arrays else "_" + k
+
+    name_stems = {}
+    for k in user_values:
+        if k[-2:] in ("_0", "_1", "_2", "_3"):
+            name_stems.setdefault(k[:-2], []).append(k)
+
+    ans = {}
+    for k, names in name_stems.items():
+        param = param_name(k)
+        defaults, is_2d = arrays[param]
+        num_years = max([len(defaults)] +
+                        [len(user_values[name]) for name in names])
+        packed = np.full((num_years, defaults.shape[1]), np.nan)
+        packed[:len(defaults)] = defaults
+        cpi_flag = discover_cpi_flag(param)
+        for name in names:
+            idx = int(name[-1])
+            user, wildcards = user_array(user_values[name])
+            col = propagate_columns(user, wildcards, packed[:, idx:idx + 1],
+                                    cpi_flag, first_budget_year)
+            with np.errstate(invalid='ignore'):
+                packed[:, idx:idx + 1] = np.where(col > 1.0, np.trunc(col), col)
+        ans[param] = array_to_list(packed, is_2d)
+
+    for k, vals in user_values.items():
+        if k in name_stems.get(k[:-2], ()):
+            continue
+        if k.endswith("_cpi") and k not in arrays:
+            ans[k if k[:-4] in arrays else '_' + k] = vals
+            continue
+
+        param = param_name(k)
+        defaults, is_2d = arrays[param]
+        cpi_flag = discover_cpi_flag(param)
+        if is_2d:
+            # Whole 2D parameters are rare, leave them to the list code
+            ans[param] = propagate_user_list(vals, defaults.tolist(),
+                                             cpi=cpi_flag,
+                                             first_budget_year=first_budget_year)
+            continue
+        if len(vals) >= len(defaults) and '*' not in vals:
+            ans[param] = vals
+            continue
+        user, wildcards = user_array(vals)
+        ans[param] = array_to_list(propagate_columns(user, wildcards, defaults,
+                                                     cpi_flag, first_budget_year),
+                                   is_2d)
+
+    return ans
+
+
 #
 # Gather data to assist in displaying TaxCalc param form
 #
@@ -645,6 +889,7 @@ class TaxCalcParam(object):
 
 
 # Create a list of default Behavior parameters
+@cache_defaults
 def default_behavior(first_budget_year):
 
     default_behavior_params = {}
@@ -660,6 +905,7 @@ def default_behavior(first_budget_year):
 
 
 # Create a list of default policy
+@cache_defaults
 def default_policy(first_budget_year):
 
     TAXCALC_DEFAULT_PARAMS_JSON = default_taxcalc_data(taxcalc.policy.Policy,
@@ -870,13 +1116,25 @@ def taxcalc_results_to_tables(results, first_budget_year):
     tables['result_years'] = years
     return tables
 
-def format_csv(tax_results, url_id, first_budget_year):
+# The tables written to CSV after the fiscal totals, in order, with their
+# column labels and row keys
+CSV_TABLES = [
+    ('mX_dec', TAXCALC_RESULTS_MTABLE_COL_LABELS, TAXCALC_RESULTS_DEC_ROW_KEYS),
+    ('mY_dec', TAXCALC_RESULTS_MTABLE_COL_LABELS, TAXCALC_RESULTS_DEC_ROW_KEYS),
+    ('df_dec', TAXCALC_RESULTS_DFTABLE_COL_LABELS, TAXCALC_RESULTS_DEC_ROW_KEYS),
+    ('mX_bin', TAXCALC_RESULTS_MTABLE_COL_LABELS, TAXCALC_RESULTS_BIN_ROW_KEYS),
+    ('mY_bin', TAXCALC_RESULTS_MTABLE_COL_LABELS, TAXCALC_RESULTS_BIN_ROW_KEYS),
+    ('df_bin', TAXCALC_RESULTS_DFTABLE_COL_LABELS, TAXCALC_RESULTS_BIN_ROW_KEYS),
+]
+
+
+def iter_csv(tax_results, url_id, first_budget_year):
     """
     Takes a dictionary with the tax_results, having these keys:
     [u'mY_bin', u'mX_bin', u'mY_dec', u'mX_dec', u'df_dec', u'df_bin',
     u'fiscal_tots']
-    And then returns a list of list of strings for CSV output. The format
-    of the lines is as follows:
+    And then yields the rows of strings for CSV output one at a time. The
+    format of the lines is as follows:
     #URL: http://www.ospc.org/taxbrain/ID/csv/
     #fiscal tots data
     YEAR_0, ... YEAR_K
@@ -930,83 +1188,33 @@ def format_csv(tax_results, url_id, first_budget_year):
     val, val, ..., val
     ...
     """
-    res = []
-
     #URL
-    res.append(["#URL: http://www.ospc.org/taxbrain/" + str(url_id) + "/"])
+    yield ["#URL: http://www.ospc.org/taxbrain/" + str(url_id) + "/"]
 
     #FISCAL TOTS
-    res.append(["#fiscal totals data"])
+    yield ["#fiscal totals data"]
     ft = tax_results.get('fiscal_tots', {})
     yrs = [first_budget_year + i for i in range(0, len(ft['ind_tax']))]
     if yrs:
-        res.append(yrs)
+        yield yrs
     if ft:
-        res.append(['payroll_tax'])
-        res.append(ft['payroll_tax'])
-        res.append(['combined_tax'])
-        res.append(ft['combined_tax'])
-        res.append(['ind_tax'])
-        res.append(ft['ind_tax'])
-
-    #MX_DEC
-    res.append(["#mX_dec"])
-    mxd = tax_results.get('mX_dec', {})
-    if mxd:
-        for count, yr in enumerate(yrs):
-            res.append([yr])
-            res.append(TAXCALC_RESULTS_MTABLE_COL_LABELS)
-            for row in TAXCALC_RESULTS_DEC_ROW_KEYS:
-                res.append(mxd[row+"_" + str(count)])
-
-    #MY_DEC
-    res.append(["#mY_dec"])
-    myd = tax_results.get('mY_dec', {})
-    if myd:
-        for count, yr in enumerate(yrs):
-            res.append([yr])
-            res.append(TAXCALC_RESULTS_MTABLE_COL_LABELS)
-            for row in TAXCALC_RESULTS_DEC_ROW_KEYS:
-                res.append(myd[row+"_" + str(count)])
-
-    #DF_DEC
-    res.append(["#df_dec"])
-    dfd = tax_results.get('df_dec', {})
-    if dfd:
-        for count, yr in enumerate(yrs):
-            res.append([yr])
-            res.append(TAXCALC_RESULTS_DFTABLE_COL_LABELS)
-            for row in TAXCALC_RESULTS_DEC_ROW_KEYS:
-                res.append(dfd[row+"_" + str(count)])
-
-    #MX_BIN
-    res.append(["#mX_bin"])
-    mxb = tax_results.get('mX_bin', {})
-    if mxb:
-        for count, yr in enumerate(yrs):
-            res.append([yr])
-            res.append(TAXCALC_RESULTS_MTABLE_COL_LABELS)
-            for row in TAXCALC_RESULTS_BIN_ROW_KEYS:
-                res.append(mxb[row+"_" + str(count)])
-
-    #MY_BIN
-    res.append(["#mY_bin"])
-    myb = tax_results.get('mY_bin', {})
-    if myb:
-        for count, yr in enumerate(yrs):
-            res.append([yr])
-            res.append(TAXCALC_RESULTS_MTABLE_COL_LABELS)
-            for row in TAXCALC_RESULTS_BIN_ROW_KEYS:
-                res.append(myb[row+"_" + str(count)])
-
-    #DF_BIN
-    res.append(["#df_bin"])
-    dfb = tax_results.get('df_bin', {})
-    if dfb:
-        for count, yr in enumerate(yrs):
-            res.append([yr])
-            res.append(TAXCALC_RESULTS_DFTABLE_COL_LABELS)
-            for row in TAXCALC_RESULTS_BIN_ROW_KEYS:
-                res.append(dfb[row+"_" + str(count)])
-
-    return res
+        for total in ['payroll_tax', 'combined_tax', 'ind_tax']:
+            yield [total]
+            yield ft[total]
+
+    for table_id, col_labels, row_keys in CSV_TABLES:
+        yield ["#" + table_id]
+        table = tax_results.get(table_id, {})
+        if table:
+            for count, yr in enumerate(yrs):
+                yield [yr]
+                yield col_labels
+                for row in row_keys:
+                    yield table[row + "_" + str(count)]
+
+
+def format_csv(tax_results, url_id, first_budget_year):
+    """
+    The rows of iter_csv, as a list of list of strings
+    """
+    return list(iter_csv(tax_results, url_id, first_budget_year))
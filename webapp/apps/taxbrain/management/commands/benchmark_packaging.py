@@ -0,0 +1,58 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from ...helpers import (package_up_vars, package_up_arrays,
+                        default_param_arrays)
+
+
+def large_reform(first_budget_year, num_years):
+    """
+    A reform that changes every policy parameter with num_years of values,
+    entering each column of the 2D parameters separately as the forms do
+    """
+    arrays, cpi_flags = default_param_arrays(first_budget_year)
+    reform = {}
+    for param, (defaults, is_2d) in arrays.items():
+        name = param[1:] if param.startswith('_') else param
+        for col in range(defaults.shape[1]):
+            value = defaults[0, col]
+            if value != value:
+                continue
+            values = [value * 1.01 + i for i in range(num_years)]
+            if is_2d:
+                reform["{0}_{1}".format(name, col)] = values
+            else:
+                reform[name] = values
+    return reform
+
+
+class Command(BaseCommand):
+    help = ("Time package_up_vars against package_up_arrays on a reform "
+            "that changes every parameter")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start-year', type=int, default=2016)
+        parser.add_argument('--years', type=int, default=1,
+                            help="Number of years of values per parameter")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        start_year = options['start_year']
+        repeat = options['repeat']
+        reform = large_reform(start_year, options['years'])
+        print "parameters in reform: ", len(reform)
+
+        # Build the caches before timing
+        package_up_vars(dict(reform), start_year)
+        package_up_arrays(reform, start_year)
+
+        for func in (package_up_vars, package_up_arrays):
+            seconds = timeit.timeit(lambda: func(dict(reform), start_year),
+                                    number=repeat)
+            print "{0}: {1:.2f} ms per reform".format(func.__name__,
+                                                      1000.0 * seconds / repeat)
+
+        same = package_up_vars(dict(reform), start_year) == \
+            package_up_arrays(reform, start_year)
+        print "same user_mods: ", same
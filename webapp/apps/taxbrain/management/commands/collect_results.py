@@ -0,0 +1,39 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from requests.exceptions import RequestException
+
+from ...collector import collect_results, outstanding_runs
+from ...compute import DropqCompute, JobFailError
+
+
+class Command(BaseCommand):
+    help = ("Poll the dropq workers for outstanding TaxBrain runs and save "
+            "the results of the finished ones")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help="Seconds to wait between polls")
+        parser.add_argument('--max-age', type=float, default=24.0,
+                            help="Ignore runs submitted more than this many "
+                                 "hours ago")
+        parser.add_argument('--once', action='store_true', default=False,
+                            help="Poll a single time and exit")
+
+    def handle(self, *args, **options):
+        compute = DropqCompute()
+        max_age = datetime.timedelta(hours=options['max_age'])
+        while True:
+            for model in outstanding_runs(max_age):
+                try:
+                    if collect_results(model, compute):
+                        print "collected results for: ", model.pk
+                except JobFailError as jfe:
+                    print jfe
+                except (RequestException, IOError) as e:
+                    print "Couldn't collect results for {0}: {1}".format(model.pk, e)
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
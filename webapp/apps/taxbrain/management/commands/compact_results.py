@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ...collector import callback_run_models
+from ...columnar import is_columnar, store_tables
+
+
+class Command(BaseCommand):
+    help = ("Move the results of runs saved as JSON in tax_result into "
+            "compact ResultTables")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Number of runs to load at a time")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for model_cls, _ in callback_run_models():
+            num_compacted = 0
+            last_pk = 0
+            while True:
+                batch = list(model_cls.objects
+                             .filter(pk__gt=last_pk, tax_result__isnull=False)
+                             .order_by('pk')[:batch_size])
+                if not batch:
+                    break
+                for model in batch:
+                    last_pk = model.pk
+                    if is_columnar(model.tax_result):
+                        continue
+                    model.tax_result = store_tables(model, model.tax_result)
+                    model.save(update_fields=['tax_result'])
+                    num_compacted += 1
+            print "compacted {0} {1} results".format(num_compacted,
+                                                     model_cls.__name__)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0020_workernodescounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taxsaveinputs',
+            name='job_failed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
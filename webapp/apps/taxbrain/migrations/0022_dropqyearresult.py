@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0021_taxsaveinputs_job_failed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DropqYearResult',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('job_id', models.CharField(max_length=100, db_index=True)),
+                ('hostname', models.CharField(max_length=255)),
+                ('status', models.CharField(max_length=10)),
+                ('result', jsonfield.fields.JSONField(default=None, null=True, blank=True)),
+                ('creation_date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
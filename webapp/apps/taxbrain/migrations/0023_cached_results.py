@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0022_dropqyearresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedResult',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(unique=True, max_length=64)),
+                ('tax_result', jsonfield.fields.JSONField(default=None, null=True, blank=True)),
+                ('creation_date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='taxsaveinputs',
+            name='result_cache_key',
+            field=models.CharField(default=None, max_length=64, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxbrain', '0023_cached_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taxsaveinputs',
+            name='tables_json',
+            field=models.TextField(default=None, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taxbrain', '0024_taxsaveinputs_tables_json'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultTable',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('table_id', models.CharField(max_length=32)),
+                ('data', models.BinaryField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='resulttable',
+            unique_together=set([('content_type', 'object_id', 'table_id')]),
+        ),
+    ]
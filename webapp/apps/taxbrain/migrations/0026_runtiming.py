@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taxbrain', '0025_resulttable'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunTiming',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('run_type', models.CharField(max_length=16)),
+                ('hostname', models.CharField(max_length=255)),
+                ('queue_depth', models.IntegerField(default=0)),
+                ('submitted', models.DateTimeField()),
+                ('seconds', models.FloatField(default=None, null=True)),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='runtiming',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taxbrain', '0026_runtiming'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('job_id', models.CharField(max_length=100, db_index=True)),
+                ('hostname', models.CharField(max_length=255)),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='runjob',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+    ]
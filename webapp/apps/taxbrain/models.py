@@ -6,6 +6,7 @@ from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator, RegexValidator
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 
 from uuidfield import UUIDField
 from jsonfield import JSONField
@@ -343,6 +344,13 @@ class TaxSaveInputs(models.Model):
     # Job IDs when running a job
     job_ids = SeparatedValuesField(blank=True, default=None, null=True)
     jobs_not_ready = SeparatedValuesField(blank=True, default=None, null=True)
+    job_failed = models.BooleanField(default=False)
+    # Key of this run's results in the CachedResult table
+    result_cache_key = models.CharField(blank=True, default=None, null=True,
+                                        max_length=64)
+    # The results tables shown on the results page, serialized when the
+    # results are stored
+    tables_json = models.TextField(blank=True, default=None, null=True)
 
     # Starting Year of the reform calculation
     first_year = models.IntegerField(default=None, null=True)
@@ -373,17 +381,98 @@ class TaxSaveInputs(models.Model):
             ("view_inputs", "Allowed to view Taxbrain."),
         )
 
+# The columns of a run that its progress page and the result collection
+# read. The parameters and the serialized tables are left deferred
+RUN_STATUS_FIELDS = ('job_ids', 'jobs_not_ready', 'job_failed', 'first_year',
+                     'creation_date', 'result_cache_key', 'tax_result')
+# The columns of a run holding its results, deferred when only the
+# inputs of the run are needed
+RUN_RESULT_FIELDS = ('tax_result', 'tables_json')
+
 class WorkerNodesCounter(models.Model):
     '''
     This class specifies a counter for which set of worker nodes we have
     just deployed a TaxBrain job to. It is a singleton class to enforce
     round robin behavior with multiple dynos running simultaneously. The
     database becomes the single source of truth for which set of nodes
-    just got the last dispatch
+    just got the last dispatch. compute.HostAllocator reserves positions
+    from it, with a row per pool of worker nodes
     '''
     singleton_enforce = models.IntegerField(default=1, unique=True)
     current_offset = models.IntegerField(default=0)
 
+class DropqYearResult(models.Model):
+    '''
+    The outcome of a single budget year's dropq job, saved as soon as the
+    worker calls back to say the job is done. A run's results are
+    assembled from these rows once every year has arrived, and the rows
+    are deleted afterwards
+    '''
+    job_id = models.CharField(max_length=100, db_index=True)
+    hostname = models.CharField(max_length=255)
+    # Either "SUCCESS" or "FAILURE"
+    status = models.CharField(max_length=10)
+    result = JSONField(default=None, blank=True, null=True)
+    creation_date = models.DateTimeField(auto_now_add=True)
+
+class CachedResult(models.Model):
+    '''
+    The results of a finished run, keyed on a hash of its packaged reform,
+    start year, taxcalc and dropq versions and run type. Identical runs are
+    answered from here instead of being sent to the workers again. Like
+    the runs, its tables are stored as ResultTables unless
+    COLUMNAR_RESULTS is off
+    '''
+    key = models.CharField(max_length=64, unique=True)
+    tax_result = JSONField(default=None, blank=True, null=True)
+    creation_date = models.DateTimeField(auto_now_add=True)
+
+class ResultTable(models.Model):
+    '''
+    One table of the results of a run, compressed by columnar.encode_table.
+    The run is any of the models with a tax_result
+    '''
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    table_id = models.CharField(max_length=32)
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'table_id'),)
+
+class RunTiming(models.Model):
+    '''
+    How long a run took on one of the hosts its years were sent to, given
+    the longest queue the hosts reported when they took the run. The
+    seconds are filled in when the run's results are saved. The run is any
+    of the models with a tax_result
+    '''
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    # Either 'dropq', 'behavior' or 'elastic', as for the result cache
+    run_type = models.CharField(max_length=16)
+    hostname = models.CharField(max_length=255)
+    queue_depth = models.IntegerField(default=0)
+    submitted = models.DateTimeField()
+    seconds = models.FloatField(default=None, null=True)
+
+    class Meta:
+        index_together = (('content_type', 'object_id'),)
+
+class RunJob(models.Model):
+    '''
+    The run a dropq job was submitted for, so that the callback of the
+    worker doing the job finds its run by the job's id. The run is any of
+    the models with a tax_result. Deleted once the run's results are saved
+    '''
+    job_id = models.CharField(max_length=100, db_index=True)
+    hostname = models.CharField(max_length=255)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+
+    class Meta:
+        index_together = (('content_type', 'object_id'),)
+
 class OutputUrl(models.Model):
     """
     This model creates a unique url for each calculation.
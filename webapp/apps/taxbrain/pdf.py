@@ -0,0 +1,230 @@
+"""
+PDF reports of the results pages.
+
+A report is rendered from the results tables of a run with the local
+taxbrain/pdf_report.html template, instead of wkhtmltopdf loading the
+results page back from the site. The conversion to PDF runs on
+PDF_WORKERS background threads fed by a queue of at most PDF_QUEUE_SIZE
+reports, and the finished reports are kept in the 'pdfs' cache, keyed by
+the run and the versions that made it. Requests wait up to PDF_TIMEOUT
+seconds for a report that isn't cached, and are then asked to come back
+for it every PDF_RETRY_IN_SECONDS. A report that
+failed to render is remembered for PDF_FAILURE_TIMEOUT seconds, during
+which it isn't tried again.
+"""
+import json
+import os
+import threading
+import Queue
+
+import pdfkit
+from django.core.cache import caches
+from django.template.loader import render_to_string
+
+from .models import TaxSaveInputs, OutputUrl
+from .helpers import taxcalc_version
+from .columnar import load_tax_result
+
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 2))
+PDF_QUEUE_SIZE = int(os.environ.get('PDF_QUEUE_SIZE', 8))
+# Seconds a request waits for its report before asking to retry, 0 to
+# answer at once. A waiting request takes up a server thread, so keep it
+# short: most reports render within it, the others are retried
+PDF_TIMEOUT = int(os.environ.get('PDF_TIMEOUT', 15))
+PDF_RETRY_IN_SECONDS = int(os.environ.get('PDF_RETRY', 5))
+PDF_FAILURE_TIMEOUT = int(os.environ.get('PDF_FAILURE_TIMEOUT', 600))
+# Cached in place of a report that failed to render. Reports start with
+# '%PDF', so this can't be mistaken for one
+RENDER_FAILED = 'render failed'
+# Bump when the report template changes, so cached reports are remade
+REPORT_VERSION = 1
+
+
+class PdfQueueFull(Exception):
+    '''
+    Raised when a report can't be queued because the queue is full
+    '''
+    pass
+
+
+class PdfRenderFailed(Exception):
+    '''
+    Raised when a report failed to render within the last
+    PDF_FAILURE_TIMEOUT seconds
+    '''
+    pass
+
+
+def year_value(year_values, year):
+    """ The value of a year in year_values, keyed by int or by string """
+    if year in year_values:
+        return year_values[year]
+    return year_values[str(year)]
+
+
+def report_tables(tables):
+    """
+    The tables of a results page laid out for the report: the fiscal
+    totals first, and a table for every year of the multi-year tables
+    """
+    years = tables.get('result_years', [])
+    table_ids = sorted((table_id for table_id in tables
+                        if table_id != 'result_years'),
+                       key=lambda table_id: (table_id != 'fiscal_tots',
+                                             table_id))
+    report = []
+    for table_id in table_ids:
+        table = tables[table_id]
+        if table['multi_valued']:
+            sections = [(u"{0} ({1})".format(table['label'], year), year)
+                        for year in years]
+        else:
+            sections = [(table['label'], None)]
+
+        for label, year in sections:
+            rows = []
+            for row in table['rows']:
+                cells = []
+                for cell in row['cells']:
+                    if year is None:
+                        value = cell['value']
+                    else:
+                        value = year_value(cell['year_values'], year)
+                    cells.append({'value': value, 'format': cell['format']})
+                rows.append({'label': row['label'], 'cells': cells})
+            report.append({'label': label, 'cols': table['cols'],
+                           'rows': rows})
+    return report
+
+
+def run_report(url_name, pk):
+    """
+    The cache key and the tables of the report of the results page
+    url_name for the run with url pk, or None if url_name is no results
+    page. The tables are returned as a function, so that they are only
+    built when the report isn't cached
+    """
+    from .collector import stored_tables_json
+    from ..dynamic.models import (DynamicBehaviorOutputUrl,
+                                  DynamicElasticityOutputUrl,
+                                  DynamicOutputUrl)
+    from ..dynamic.helpers import (elast_results_to_tables,
+                                   ogusa_results_to_tables)
+
+    def taxbrain_tables():
+        url = OutputUrl.objects.get(pk=pk)
+        model = (TaxSaveInputs.objects
+                 .only('tax_result', 'first_year', 'tables_json')
+                 .get(pk=url.unique_inputs_id))
+        return json.loads(stored_tables_json(model))
+
+    def behavior_tables():
+        model = DynamicBehaviorOutputUrl.objects.get(pk=pk).unique_inputs
+        return json.loads(stored_tables_json(model))
+
+    def elastic_tables():
+        model = DynamicElasticityOutputUrl.objects.get(pk=pk).unique_inputs
+        return elast_results_to_tables(load_tax_result(model),
+                                       model.first_year)
+
+    def ogusa_tables():
+        model = DynamicOutputUrl.objects.get(pk=pk).unique_inputs
+        return ogusa_results_to_tables(model.tax_result, model.first_year)
+
+    reports = {'output_detail': taxbrain_tables,
+               'behavior_output': behavior_tables,
+               'elastic_output': elastic_tables,
+               'ogusa_results': ogusa_tables}
+    if url_name not in reports:
+        return None
+    key = "pdf_report:{0}:{1}:{2}:{3}".format(url_name, pk, taxcalc_version,
+                                              REPORT_VERSION)
+    return key, reports[url_name]
+
+
+class PdfRenderer(object):
+    '''
+    Converts report HTML to PDF on background threads, feeding them from
+    a bounded queue. A report already queued or being converted is not
+    queued again
+    '''
+
+    def __init__(self, num_workers, queue_size):
+        self.num_workers = num_workers
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.pending = {}
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            while len(self.workers) < self.num_workers:
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, key, make_html):
+        """
+        Queue the conversion of the HTML made by make_html, to be saved
+        in the cache under key. Returns an Event set once it is done
+        """
+        self.start()
+        with self.lock:
+            done = self.pending.get(key)
+        if done is not None:
+            return done
+
+        html = make_html()
+        with self.lock:
+            done = self.pending.get(key)
+            if done is None:
+                done = threading.Event()
+                try:
+                    self.queue.put_nowait((key, html, done))
+                except Queue.Full:
+                    raise PdfQueueFull()
+                self.pending[key] = done
+        return done
+
+    def work(self):
+        while True:
+            key, html, done = self.queue.get()
+            try:
+                caches['pdfs'].set(key, pdfkit.from_string(html, False))
+            except Exception as e:
+                print "PDF rendering of {0} failed: {1}".format(key, e)
+                caches['pdfs'].set(key, RENDER_FAILED, PDF_FAILURE_TIMEOUT)
+            finally:
+                with self.lock:
+                    del self.pending[key]
+                done.set()
+
+PDF_RENDERER = PdfRenderer(PDF_WORKERS, PDF_QUEUE_SIZE)
+
+
+def report_pdf(key, make_tables, timeout=PDF_TIMEOUT):
+    """
+    The PDF report of a run_report, or None if it isn't ready within
+    timeout seconds. Raises PdfQueueFull when too many reports are being
+    made, PdfRenderFailed if the report failed to render recently, and a
+    DoesNotExist error if there is no such run
+    """
+    pdf = caches['pdfs'].get(key)
+    if pdf == RENDER_FAILED:
+        raise PdfRenderFailed()
+    if pdf is not None:
+        return pdf
+
+    def make_html():
+        return render_to_string('taxbrain/pdf_report.html',
+                                {'tables': report_tables(make_tables()),
+                                 'taxcalc_version': taxcalc_version})
+
+    done = PDF_RENDERER.submit(key, make_html)
+    if timeout:
+        done.wait(timeout)
+    pdf = caches['pdfs'].get(key)
+    if pdf == RENDER_FAILED:
+        raise PdfRenderFailed()
+    return pdf
@@ -1,9 +1,12 @@
 from django.test import TestCase
+import json
 
 from ..models import TaxSaveInputs, WorkerNodesCounter
 from ..models import convert_to_floats
 from ..helpers import (expand_1D, expand_2D, expand_list, package_up_vars,
-                     format_csv, arrange_totals_by_row, default_taxcalc_data)
+                     format_csv, arrange_totals_by_row, default_taxcalc_data,
+                     default_policy, indexing_rates, propagate_user_list,
+                     package_up_arrays)
 from ...taxbrain import compute as compute
 from ..views import convert_val
 import taxcalc
@@ -12,37 +15,139 @@ import pytest
 
 FBY = 2015
 
+
+def setup_module(module):
+    # The mock jobs are built for a single worker and two budget years,
+    # whatever the environment says
+    compute.DROPQ_WORKERS = ['localhost:5050']
+    compute.NUM_BUDGET_YEARS = 2
+
 @pytest.mark.django_db
 def test_compute():
     assert compute
-    compute.DROPQ_WORKERS = [1,2,3,4,5,6,7,8,9,10]
-    compute.NUM_BUDGET_YEARS = 5
-    wnc, created = WorkerNodesCounter.objects.get_or_create(singleton_enforce=1)
-    dropq_worker_offset = wnc.current_offset
-    hostnames = compute.DROPQ_WORKERS[dropq_worker_offset:
-        dropq_worker_offset + compute.NUM_BUDGET_YEARS]
-    assert hostnames == [1,2,3,4,5]
-    wnc.current_offset = (dropq_worker_offset + compute.NUM_BUDGET_YEARS) % len(compute.DROPQ_WORKERS)
-    wnc.save()
-
-    assert wnc.current_offset == 5
-    dropq_worker_offset = wnc.current_offset
-    hostnames = compute.DROPQ_WORKERS[dropq_worker_offset:
-        dropq_worker_offset + compute.NUM_BUDGET_YEARS]
-    assert hostnames == [6,7,8,9,10]
-    wnc.current_offset = (dropq_worker_offset + compute.NUM_BUDGET_YEARS) % len(compute.DROPQ_WORKERS)
-    wnc.save()
-
-    assert wnc.current_offset == 0
-    dropq_worker_offset = wnc.current_offset
-    hostnames = compute.DROPQ_WORKERS[dropq_worker_offset:
-        dropq_worker_offset+ compute.NUM_BUDGET_YEARS]
-    assert hostnames == [1,2,3,4,5]
-    #Reset to original values
-    compute.DROPQ_WORKERS = ['localhost:5050']
-    wnc.current_offset = 0
-    wnc.save()
-    compute.NUM_BUDGET_YEARS = 2
+    allocator = compute.HostAllocator(99)
+    workers = [1,2,3,4,5,6,7,8,9,10]
+    num_years = 5
+    # Every submission gets the next num_years positions
+    offset = allocator.allocate(num_years) % len(workers)
+    assert offset == 0
+    next_offset = allocator.allocate(num_years) % len(workers)
+    assert next_offset == (offset + num_years) % len(workers)
+    # Other processes continue from the same counter
+    other = compute.HostAllocator(99)
+    assert other.allocate(num_years) % len(workers) == offset
+    assert WorkerNodesCounter.objects.get(singleton_enforce=99).current_offset == 15
+
+
+def test_submit_year_rotates_hosts():
+    node_down = compute.NodeDownCompute()
+    job_id, hostname, qlength = node_down.submit_year(
+        "http://{hn}/dropq_start_job", {'user_mods': '{}'}, 0,
+        ['host1', 'host2'], 0)
+    # The first host answers with a 502, so the job lands on the second one
+    assert job_id == '424242'
+    assert hostname == 'host2'
+    assert qlength == 2
+
+
+@pytest.mark.django_db
+def test_submit_packages_reform():
+    # Every year is sent the reform as package_up_vars packages it
+    reform = {"II_brk2_0": [36000., 38000.], "II_brk2_1": [72250.],
+              "II_em": [4000], "CTC_c": [2000.0], "CTC_c_cpi": True,
+              "AMT_tthd": ['*', '*', 204000.]}
+    submitted = []
+
+    class RecordingCompute(compute.MockCompute):
+        def remote_submit_job(self, theurl, data, timeout):
+            submitted.append(json.loads(data['user_mods']))
+            return compute.MockCompute.remote_submit_job(self, theurl, data,
+                                                         timeout)
+
+    job_ids, qlength = RecordingCompute().submit_dropq_calculation(dict(reform),
+                                                                   FBY)
+    assert len(job_ids) == compute.NUM_BUDGET_YEARS
+    exp = json.loads(json.dumps({FBY: package_up_vars(dict(reform), FBY)}))
+    assert submitted
+    assert all(user_mods == exp for user_mods in submitted)
+
+
+def test_host_load_assigns_least_loaded():
+    host_load = compute.HostLoad()
+    hosts = ['host1', 'host2', 'host3']
+    # Without any reports the hosts take turns from the offset
+    assert host_load.assign(hosts, 4, offset=1) == [1, 2, 0, 1]
+    host_load.record_submit('host1', 6, 0.0)
+    host_load.record_submit('host2', 1, 0.0)
+    host_load.record_failure('host3')
+    assert host_load.assign(hosts, 4) == [1, 1, 1, 1]
+    assert host_load.assign(hosts, 7) == [1, 1, 1, 1, 1, 0, 1]
+
+
+def test_host_health_circuit_breaker():
+    health = compute.HostHealth()
+    hosts = ['host1', 'host2']
+    for _ in range(compute.HOST_FAILURE_THRESHOLD):
+        assert health.allow('host1')
+        health.record_failure('host1')
+    # The dead host is left out until a trial is due
+    assert health.excluded() == ['host1']
+    assert health.available(hosts) == ['host2']
+    assert not health.allow('host1')
+    breaker = health.breaker('host1')
+    breaker.opened_at -= compute.HOST_RESET_TIMEOUT_IN_SECONDS
+    assert health.available(hosts) == hosts
+    assert health.allow('host1')
+    assert breaker.state == compute.CircuitBreaker.HALF_OPEN
+    # Only one trial at a time, and its success closes the breaker
+    assert not health.allow('host1')
+    health.record_success('host1')
+    assert breaker.state == compute.CircuitBreaker.CLOSED
+    assert health.excluded() == []
+    # With every host left out they are all tried anyway
+    for hostname in hosts:
+        for _ in range(compute.HOST_FAILURE_THRESHOLD):
+            health.record_failure(hostname)
+    assert health.available(hosts) == hosts
+
+
+def test_host_health_probe():
+    import mock
+    from requests.exceptions import ConnectionError
+    health = compute.HostHealth()
+    # Watching hosts doesn't start probing them
+    health.watch(['host1'])
+    assert health.heartbeat is None
+    # Server errors and unreachable hosts count as failures
+    session = mock.Mock()
+    with mock.patch.object(compute, 'get_session', return_value=session):
+        session.get.return_value = mock.Mock(status_code=503)
+        health.probe('host1')
+        session.get.side_effect = ConnectionError()
+        health.probe('host1')
+    assert health.breaker('host1').failures == 2
+    session.get.side_effect = None
+    session.get.return_value = mock.Mock(status_code=404)
+    with mock.patch.object(compute, 'get_session', return_value=session):
+        health.probe('host1')
+    assert health.breaker('host1').failures == 0
+
+
+def test_results_ready_same_host():
+    mock_compute = compute.MockCompute(num_times_to_wait=1)
+    job_ids = [('424242', 'host1'), ('424243', 'host1'), ('424244', 'host2')]
+    # Only the first query of the poll is told to wait
+    assert mock_compute.dropq_results_ready(job_ids).count(False) == 1
+    assert mock_compute.dropq_results_ready(job_ids) == [True, True, True]
+
+
+def test_dropq_get_results_merges_years():
+    mock_compute = compute.MockCompute()
+    job_ids = [('424242', 'host1'), ('424243', 'host2')]
+    results = mock_compute.dropq_get_results(job_ids)
+    assert sorted(results.keys()) == sorted(compute.TAXCALC_RESULTS_TABLE_IDS)
+    assert 'all_0' in results['df_bin'] and 'all_1' in results['df_bin']
+    assert len(results['fiscal_tots']['ind_tax']) == 2
 
 
 def test_convert_val():
@@ -352,3 +457,103 @@ class TaxInputTests(TestCase):
         assert dd_meta['_II_em']['value'] == floored_ii_em
 
         assert dd_raw['_II_rt6'] == dd['_II_rt6']
+
+    def test_default_taxcalc_data_copy_on_read(self):
+        dd = default_taxcalc_data(taxcalc.policy.Policy, start_year=2017)
+        dd['_II_em'][0] = -1
+        dd2 = default_taxcalc_data(taxcalc.policy.Policy, start_year=2017)
+        assert dd2['_II_em'][0] != -1
+
+        params = default_policy(2017)
+        params['II_em'].col_fields[0].values[0] = -1
+        params2 = default_policy(2017)
+        assert params2['II_em'].col_fields[0].values[0] != -1
+
+    def test_indexing_rates_cached(self):
+        pp = Policy(start_year=2013)
+        pp.set_year(FBY)
+        irates = pp.indexing_rates_for_update(param_name='II_brk2', calyear=FBY,
+                                              num_years_to_expand=3)
+        cached = indexing_rates(FBY, 3)
+        assert list(cached) == list(irates)
+        assert indexing_rates(FBY, 3) is cached
+
+        # Rates compound over the years after the last user value
+        ans = propagate_user_list([0.2], [0.1, 0.1, 0.1], cpi=True,
+                                  first_budget_year=FBY)
+        assert ans[0] == 0.2
+        assert abs(ans[2] - 0.2 * (1.0 + irates[0]) * (1.0 + irates[1])) < 1e-12
+
+    def test_package_up_arrays_matches_package_up_vars(self):
+        reforms = [{"II_brk2_0": [36000., 38000., 40000., 41000],
+                    "II_brk2_1": [72250., 74000.],
+                    "II_brk2_2": [36500.],
+                    "II_em": [4000]},
+                   {"AMT_tthd": ['*','*',204000.]},
+                   {"CTC_c": [2000.0], "CTC_c_cpi": True},
+                   {"FEI_ec_c": [100000.]},
+                   {'EITC_rt_2': [0.44], 'EITC_rt_0': [0.08415],
+                    'EITC_rt_1': [0.374, 0.39], 'EITC_rt_3': [0.495]},
+                   {'FICA_ss_trt': [0.11], 'BE_inc': [0.04]},
+                   {'SS_Earnings_c': [118500, 999999]}]
+        for reform in reforms:
+            ans = package_up_arrays(dict(reform), first_budget_year=FBY)
+            exp = package_up_vars(dict(reform), first_budget_year=FBY)
+            assert ans == exp
+
+    def test_validation_plan(self):
+        from ..forms import ValidationPlan
+        from ..helpers import TaxCalcParam
+
+        def param(param_id, value, validations):
+            attrs = {'value': value, 'col_label': '', 'long_name': param_id,
+                     'description': '', 'irs_ref': '', 'notes': '',
+                     'inflatable': False, 'validations': validations}
+            return TaxCalcParam(param_id, attrs, FBY)
+
+        low = param('_low', [100, 100], {'max': '_high'})
+        high = param('_high', [200, 200], {'min': 150})
+        bad = param('_bad', [50, 50], {'min': 'default', 'max': 40})
+        plan = ValidationPlan({'low': low, 'high': high, 'bad': bad})
+
+        # Only the validation whose defaults fail runs with nothing submitted
+        assert [v.field_id for v in plan.to_run([])] == ['bad']
+        # Submitting high also validates the field compared against it
+        run = sorted(v.field_id for v in plan.to_run(['high']))
+        assert run == ['bad', 'high', 'low']
+        run = sorted(v.field_id for v in plan.to_run(['low']))
+        assert run == ['bad', 'low']
+
+    def test_form_placeholders_per_year(self):
+        from ..forms import PersonalExemptionForm, TAXCALC_DEFAULTS_2016
+        default_2016 = TAXCALC_DEFAULTS_2016['II_em'].col_fields[0].default_value
+        default_2017 = default_policy(2017)['II_em'].col_fields[0].default_value
+
+        form_2017 = PersonalExemptionForm(2017)
+        form_2016 = PersonalExemptionForm(2016)
+        assert form_2017.fields['II_em'].widget.attrs['placeholder'] == default_2017
+        assert form_2016.fields['II_em'].widget.attrs['placeholder'] == default_2016
+
+        # The widgets shared by all forms are left alone
+        widget = PersonalExemptionForm._meta.widgets['II_em']
+        assert widget.attrs['placeholder'] == default_2016
+        assert form_2017.fields['II_em'].widget is not widget
+
+    def test_columnar_tables_round_trip(self):
+        import json
+        import os
+        from ..columnar import encode_table, decode_table, FORMAT_COLUMNAR
+
+        path = os.path.join(os.path.dirname(__file__), 'response_year_0.json')
+        with open(path) as f:
+            response = json.load(f)
+
+        for table_id in compute.TAXCALC_RESULTS_TABLE_IDS:
+            table = response[table_id]
+            blob = encode_table(table)
+            assert ord(blob[0]) == FORMAT_COLUMNAR
+            assert decode_table(blob) == table
+
+        # Tables that can't be stored as columns are kept as they are
+        table = {'ind_tax': ['1.5', '2.25'], 'x_0': ['n/a', '1e-05']}
+        assert decode_table(encode_table(table)) == table
@@ -1,13 +1,17 @@
 from django.test import TestCase
 from django.test import Client
+import json
 import mock
 
-from ..models import TaxSaveInputs
+from ..models import (TaxSaveInputs, OutputUrl, DropqYearResult, CachedResult,
+                      RunJob)
+from ..columnar import load_tax_result, is_columnar
 from ..models import convert_to_floats
 from ..helpers import (expand_1D, expand_2D, expand_list, package_up_vars,
                      format_csv, arrange_totals_by_row, default_taxcalc_data)
 from ..compute import (DropqCompute, MockCompute, MockFailedCompute,
                        NodeDownCompute)
+from ..collector import collect_results
 import taxcalc
 from taxcalc import Policy
 from .utils import *
@@ -21,6 +25,32 @@ class TaxBrainViewsTests(TestCase):
         # Every test needs a client.
         self.client = Client()
 
+    def submit_reform(self, II_em=u'4333', compute=None):
+        '''
+        Post a reform for compute, a MockCompute by default, to run, and
+        return the redirect to its results and the pk of their OutputUrl
+        '''
+        from webapp.apps.taxbrain import views as webapp_views
+        webapp_views.dropq_compute = compute or MockCompute()
+
+        data = {u'has_errors': [u'False'], u'II_em': [II_em],
+                u'start_year': unicode(START_YEAR), 'csrfmiddlewaretoken':'abc123'}
+
+        response = self.client.post('/taxbrain/', data)
+        self.assertEqual(response.status_code, 302)
+        link_idx = response.url[:-1].rfind('/')
+        return response, int(response.url[link_idx+1:-1])
+
+    def collect_reform(self, II_em=u'4333'):
+        '''
+        Post a reform and collect its results, returning the redirect to
+        them, the pk of their OutputUrl and the run
+        '''
+        response, model_num = self.submit_reform(II_em)
+        model = OutputUrl.objects.get(pk=model_num).unique_inputs
+        self.assertTrue(collect_results(model, MockCompute()))
+        return response, model_num, model
+
     def test_taxbrain_get(self):
         # Issue a GET request.
         response = self.client.get('/taxbrain/')
@@ -28,6 +58,19 @@ class TaxBrainViewsTests(TestCase):
         # Check that the response is 200 OK.
         self.assertEqual(response.status_code, 200)
 
+    def test_taxbrain_get_cached_sections(self):
+        from django.core.cache import caches
+        caches['fragments'].clear()
+
+        # The first GET renders the parameter sections, the second one
+        # reads them from the fragment cache
+        response = self.client.get('/taxbrain/')
+        self.assertEqual(response.status_code, 200)
+        cached = self.client.get('/taxbrain/')
+        self.assertEqual(cached.status_code, 200)
+        self.assertContains(cached, 'id="payroll-taxes"')
+        self.assertContains(cached, 'name="II_em"')
+
     def test_taxbrain_post(self):
         #Monkey patch to mock out running of compute jobs
         import sys
@@ -125,6 +168,296 @@ class TaxBrainViewsTests(TestCase):
         # Make sure the failure message is in the response
         self.failUnless("Your calculation failed" in str(response))
 
+    def test_taxbrain_collect_results(self):
+        response, model_num = self.submit_reform()
+        model = OutputUrl.objects.get(pk=model_num).unique_inputs
+
+        # The first poll finds one job still running
+        compute = MockCompute(num_times_to_wait=1)
+        self.assertFalse(collect_results(model, compute))
+        self.assertEqual(len(model.jobs_not_ready), 1)
+        self.assertTrue(collect_results(model, compute))
+        self.assertTrue(model.tax_result)
+        # The results tables are serialized along with the results
+        tables = json.loads(model.tables_json)
+        self.assertIn('result_years', tables)
+
+        # The results page is now served from the database
+        response = self.client.get(response.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_taxbrain_collect_results_status_columns(self):
+        import datetime
+        from ..collector import outstanding_runs
+        response, _ = self.submit_reform()
+
+        # Outstanding runs are loaded without their parameters, and saving
+        # their results leaves the parameters alone
+        model, = outstanding_runs(datetime.timedelta(hours=1))
+        self.assertIn('II_em', model.get_deferred_fields())
+        self.assertIn('tables_json', model.get_deferred_fields())
+        self.assertTrue(collect_results(model, MockCompute()))
+        model = TaxSaveInputs.objects.get(pk=model.pk)
+        self.assertEqual(model.II_em, u'4333')
+        self.assertIn('result_years', json.loads(model.tables_json))
+
+        response = self.client.get(response.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_taxbrain_run_timings(self):
+        from webapp.apps.taxbrain import views as webapp_views
+        from ..eta import RUN_TIMES, poll_interval
+        from ..models import RunTiming
+        # Without timings the estimate is the rule of thumb
+        RUN_TIMES.refresh(force=True)
+
+        response, model_num = self.submit_reform()
+        timings = RunTiming.objects.all()
+        self.assertTrue(timings)
+        self.assertEqual(set(t.run_type for t in timings), set(['dropq']))
+        self.assertEqual(set(t.seconds for t in timings), set([None]))
+
+        # While the run is going the client is told when to ask again
+        webapp_views.dropq_compute = MockCompute(num_times_to_wait=1)
+        status = self.client.post(response.url)
+        self.assertEqual(status.status_code, 202)
+        self.assertIn('poll_interval', json.loads(status.content))
+
+        url = OutputUrl.objects.get(pk=model_num)
+        self.assertTrue(collect_results(url.unique_inputs, MockCompute()))
+        for timing in RunTiming.objects.all():
+            self.assertGreaterEqual(timing.seconds, 0)
+
+        # Estimates follow the recorded timings instead of the rule of thumb
+        RunTiming.objects.update(seconds=600)
+        RUN_TIMES.refresh(force=True)
+        estimate = RUN_TIMES.estimate('dropq', [timing.hostname],
+                                      timing.queue_depth)
+        self.assertEqual(estimate, 600)
+
+        self.assertEqual(poll_interval(3600), 60)
+        self.assertEqual(poll_interval(20), 5)
+        self.assertEqual(poll_interval(0), 2)
+
+    def test_taxbrain_output_status(self):
+        from webapp.apps.taxbrain import views as webapp_views
+        from ..events import EVENT_BUS, run_channel
+        response, model_num = self.submit_reform()
+        status_url = response.url + 'status/'
+
+        # Without a token the current progress is returned at once
+        status = json.loads(self.client.get(status_url).content)
+        self.assertEqual(status['state'], 'running')
+        self.assertEqual(status['years_done'], 0)
+        self.assertIn('eta', status)
+
+        # With no room to hold it, a request is answered at once and told
+        # when to ask again
+        import threading
+        with mock.patch.object(webapp_views, '_held_status_requests',
+                               threading.BoundedSemaphore(1)) as held:
+            held.acquire()
+            unchanged = json.loads(self.client.get(status_url, {'since': status['token']}).content)
+        self.assertEqual(unchanged['token'], status['token'])
+        self.assertGreater(unchanged['poll_interval'], 0)
+
+        # A held request that sees no change is told to wait before asking
+        # again, and leaves the workers to the background collector
+        with mock.patch.multiple(webapp_views, STATUS_WAIT_IN_SECONDS=0.05,
+                                 STATUS_RECHECK_IN_SECONDS=0.01,
+                                 BACKGROUND_COLLECTOR=True):
+            with mock.patch.object(webapp_views, 'collect_results') as collect:
+                unchanged = json.loads(self.client.get(status_url, {'since': status['token']}).content)
+        self.assertFalse(collect.called)
+        self.assertEqual(unchanged['token'], status['token'])
+        self.assertGreater(unchanged['poll_interval'], 0)
+
+        # A request with the current token waits for a change, and finds
+        # the run done when it asks the workers again
+        with mock.patch.object(webapp_views, 'STATUS_RECHECK_IN_SECONDS', 0.01):
+            status = json.loads(self.client.get(status_url, {'since': status['token']}).content)
+        self.assertEqual(status['state'], 'done')
+        self.assertEqual(status['years_done'], status['years'])
+
+        self.assertEqual(status['poll_interval'], 0)
+
+        # Publishing on a run's channel wakes its waiters, however either
+        # side loaded the run
+        pk = OutputUrl.objects.get(pk=model_num).unique_inputs_id
+        waiting = TaxSaveInputs.objects.only('job_ids', 'tax_result').get(pk=pk)
+        publishing = TaxSaveInputs.objects.defer('II_em').get(pk=pk)
+        self.assertEqual(run_channel(waiting), run_channel(publishing))
+        event = EVENT_BUS.listen(run_channel(waiting))
+        EVENT_BUS.publish(run_channel(publishing))
+        self.assertTrue(event.is_set())
+
+    def test_taxbrain_run_csv_rows(self):
+        from webapp.apps.taxbrain import views as webapp_views
+        _, model_num, model = self.collect_reform()
+
+        # Unknown runs are left out of a multi-run export
+        rows = format_csv(load_tax_result(model), model_num, START_YEAR)
+        multi_rows = list(webapp_views.run_csv_rows([model_num, 0, model_num]))
+        self.assertEqual(multi_rows, rows + rows)
+        lines = list(webapp_views.stream_csv(rows))
+        self.assertEqual(len(lines), len(rows))
+        self.assertTrue(lines[0].startswith("#URL: "))
+
+    def test_taxbrain_outputs_archive(self):
+        import tarfile
+        from cStringIO import StringIO
+        from ..export import archive_chunks, batch_results
+
+        url_pks = [self.collect_reform(II_em)[1]
+                   for II_em in [u'4333', u'4334']]
+
+        # A batch of runs takes the same three queries however big it is
+        batch_results(url_pks)
+        with self.assertNumQueries(3):
+            runs = batch_results(url_pks)
+        self.assertEqual([run[0] for run in runs], url_pks)
+
+        archive = StringIO("".join(archive_chunks(url_pks, batch_size=1)))
+        tar = tarfile.open(fileobj=archive, mode='r:')
+        names = tar.getnames()
+        self.assertIn('fiscal_tots/part-00000.csv', names)
+        self.assertIn('mX_dec/part-00001.csv', names)
+        lines = tar.extractfile('fiscal_tots/part-00001.csv').read().splitlines()
+        self.assertEqual(lines[0], 'run_id,year,row,value')
+        self.assertTrue(lines[1].startswith(str(url_pks[1]) + ','))
+
+        # Malformed requests are turned down
+        from django.contrib.auth.models import User, Permission
+        user = User.objects.create_user('exporter', password='secret')
+        user.user_permissions.add(Permission.objects.get(codename='view_inputs',
+                                                         content_type__app_label='taxbrain'))
+        self.client.login(username='exporter', password='secret')
+        self.assertEqual(self.client.get('/taxbrain/outputs.tar/',
+                                         {'pks': 'a,b'}).status_code, 400)
+        response = self.client.get('/taxbrain/outputs.tar/',
+                                   {'pks': ','.join(map(str, url_pks))},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        # Compressed once, by the middleware
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'application/x-tar')
+
+    def test_taxbrain_pdf_report(self):
+        from ..pdf import (run_report, report_pdf, report_tables,
+                           PdfRenderFailed)
+        response, model_num, model = self.collect_reform()
+
+        self.assertIsNone(run_report('tax_form', None))
+        key, make_tables = run_report('output_detail', model_num)
+        tables = report_tables(make_tables())
+        self.assertEqual(tables[0]['label'],
+                         json.loads(model.tables_json)['fiscal_tots']['label'])
+
+        # The report is rendered once, then served from the cache
+        from django.core.cache import caches
+        caches['pdfs'].clear()
+        with mock.patch('webapp.apps.taxbrain.pdf.pdfkit.from_string',
+                        return_value='%PDF') as from_string:
+            self.assertEqual(report_pdf(key, make_tables, timeout=10), '%PDF')
+            self.assertEqual(report_pdf(key, make_tables), '%PDF')
+            self.assertEqual(from_string.call_count, 1)
+
+        # A failed rendering isn't tried again for a while
+        caches['pdfs'].clear()
+        with mock.patch('webapp.apps.taxbrain.pdf.pdfkit.from_string',
+                        side_effect=IOError('wkhtmltopdf')) as from_string:
+            with self.assertRaises(PdfRenderFailed):
+                report_pdf(key, make_tables, timeout=10)
+            with self.assertRaises(PdfRenderFailed):
+                report_pdf(key, make_tables)
+            self.assertEqual(from_string.call_count, 1)
+
+        # Until the report is ready, the page asks for it again
+        from django.contrib.auth.models import User, Permission
+        user = User.objects.create_user('reader', password='secret')
+        user.user_permissions.add(Permission.objects.get(codename='view_inputs',
+                                                         content_type__app_label='taxbrain'))
+        self.client.login(username='reader', password='secret')
+        from urlparse import urljoin
+        with mock.patch('webapp.apps.taxbrain.views.report_pdf',
+                        return_value=None):
+            pending = self.client.get('/taxbrain/pdf/',
+                                      HTTP_REFERER=urljoin('http://testserver',
+                                                           response.url))
+        self.assertEqual(pending.status_code, 202)
+        self.assertIn('page=', pending['Refresh'])
+        with mock.patch('webapp.apps.taxbrain.views.report_pdf',
+                        return_value='%PDF'):
+            ready = self.client.get(pending['Refresh'].split('url=')[1])
+        self.assertEqual(ready.status_code, 200)
+        self.assertEqual(ready['Content-Type'], 'application/pdf')
+
+    def test_taxbrain_result_cache(self):
+        _, _, model = self.collect_reform()
+        self.assertEqual(CachedResult.objects.count(), 1)
+        # The cache entry keeps its tables compressed, like the run
+        cached = CachedResult.objects.get()
+        self.assertTrue(is_columnar(cached.tax_result))
+        self.assertEqual(load_tax_result(cached), load_tax_result(model))
+
+        # An entry left without its results is filled in again
+        from ..collector import cache_results
+        CachedResult.objects.update(tax_result=None)
+        cache_results(cached.key, load_tax_result(model))
+        cached = CachedResult.objects.get()
+        self.assertEqual(load_tax_result(cached), load_tax_result(model))
+
+        # The same reform again is answered without submitting any jobs
+        class NoSubmitCompute(MockCompute):
+            def remote_submit_job(self, theurl, data, timeout):
+                raise AssertionError("an identical run was submitted")
+        response, model_num = self.submit_reform(compute=NoSubmitCompute())
+        cached_model = OutputUrl.objects.get(pk=model_num).unique_inputs
+        self.assertEqual(cached_model.result_cache_key, model.result_cache_key)
+        self.assertEqual(load_tax_result(cached_model), load_tax_result(model))
+        response = self.client.get(response.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_taxbrain_dropq_callbacks(self):
+        #Monkey patch to mock out running of compute jobs
+        from webapp.apps.taxbrain import views as webapp_views
+        webapp_views.dropq_compute = MockCompute()
+
+        from ..collector import record_run_jobs
+        model = TaxSaveInputs.objects.create(job_ids=[u'1#host1', u'2#host2'],
+                                             first_year=START_YEAR)
+        record_run_jobs(model, [(u'1', u'host1'), (u'2', u'host2')])
+
+        # Callbacks without a job id or status are turned down
+        for params in [{}, {'job_id': '1'}, {'job_id': '1', 'status': 'DONE'},
+                       {'job_id': '', 'status': 'SUCCESS'}]:
+            response = self.client.get('/taxbrain/dropq_finished/', params)
+            self.assertEqual(response.status_code, 400)
+
+        # Only the run of that very job id is found
+        response = self.client.get('/taxbrain/dropq_finished/',
+                                   {'job_id': 'host', 'status': 'SUCCESS'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(DropqYearResult.objects.count(), 0)
+
+        # The first year is saved on its own
+        response = self.client.get('/taxbrain/dropq_finished/',
+                                   {'job_id': '1', 'status': 'SUCCESS'})
+        self.assertEqual(response.status_code, 200)
+        model = TaxSaveInputs.objects.get(pk=model.pk)
+        self.assertFalse(model.tax_result)
+        self.assertEqual(DropqYearResult.objects.count(), 1)
+
+        # The last year completes the run
+        response = self.client.get('/taxbrain/dropq_finished/',
+                                   {'job_id': '2', 'status': 'SUCCESS'})
+        self.assertEqual(response.status_code, 200)
+        model = TaxSaveInputs.objects.get(pk=model.pk)
+        tax_result = load_tax_result(model)
+        self.assertEqual(len(tax_result['fiscal_tots']['ind_tax']), 2)
+        self.assertEqual(DropqYearResult.objects.count(), 0)
+        self.assertEqual(RunJob.objects.count(), 0)
+
     def test_taxbrain_has_growth_params(self):
         #Monkey patch to mock out running of compute jobs
         import sys
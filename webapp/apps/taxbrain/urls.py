@@ -1,13 +1,19 @@
 from django.conf.urls import patterns, include, url
 
-from .views import personal_results, output_detail, csv_input, csv_output, pdf_view, edit_personal_results
+from .views import (personal_results, output_detail, csv_input, csv_output,
+                    csv_outputs, outputs_archive, pdf_view,
+                    edit_personal_results, dropq_finished, output_status)
 
 
 urlpatterns = patterns('',
     url(r'^$', personal_results, name='tax_form'),
     url(r'^(?P<pk>\d+)/output.csv/$', csv_output, name='csv_output'),
+    url(r'^outputs.csv/$', csv_outputs, name='csv_outputs'),
+    url(r'^outputs.tar/$', outputs_archive, name='outputs_archive'),
     url(r'^(?P<pk>\d+)/input.csv/$', csv_input, name='csv_input'),
+    url(r'^(?P<pk>\d+)/status/$', output_status, name='output_status'),
     url(r'^(?P<pk>\d+)/', output_detail, name='output_detail'),
     url(r'^pdf/$', pdf_view),
+    url(r'^dropq_finished/', dropq_finished, name='dropq_finished'),
     url(r'^edit/(?P<pk>\d+)/', edit_personal_results, name='edit_personal_results'),
 )
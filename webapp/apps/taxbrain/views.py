@@ -1,6 +1,6 @@
 import csv
-import pdfkit
 import json
+import os
 import pytz
 
 #Mock some module for imports because we can't fit them on Heroku slugs
@@ -16,28 +16,45 @@ import taxcalc
 import dropq
 import datetime
 import logging
+import threading
+import time
+from urllib import urlencode
 from urlparse import urlparse, parse_qs
 from ipware.ip import get_real_ip
 
-from django.core import serializers
 from django.core.context_processors import csrf
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.core.urlresolvers import resolve, reverse
 from django.contrib.auth.decorators import login_required, permission_required
-from django.http import HttpResponseRedirect, HttpResponse, Http404, JsonResponse
+from django.http import (HttpResponseRedirect, HttpResponse, Http404, JsonResponse,
+                         StreamingHttpResponse, HttpResponseBadRequest)
 from django.shortcuts import render, render_to_response, get_object_or_404, redirect
 from django.template import loader, Context
 from django.template.context import RequestContext
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import DetailView, TemplateView
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
 from django import forms
 
 from djqscsv import render_to_csv_response
 
 from .forms import PersonalExemptionForm, has_field_errors
-from .models import TaxSaveInputs, OutputUrl
-from .helpers import default_policy, taxcalc_results_to_tables, format_csv
+from .models import (TaxSaveInputs, OutputUrl, RunJob, RUN_STATUS_FIELDS,
+                     RUN_RESULT_FIELDS)
+from .helpers import default_policy, iter_csv, denormalize
 from .compute import DropqCompute, MockCompute, JobFailError
+from .columnar import load_tax_result
+from .eta import start_timing, poll_interval
+from .events import EVENT_BUS, run_channel
+from .pdf import (run_report, report_pdf, PdfQueueFull, PdfRenderFailed,
+                  PDF_RETRY_IN_SECONDS)
+from .export import (archive_chunks, batch_results, EXPORT_BATCH_SIZE,
+                     EXPORT_MAX_RUNS)
+from .collector import (collect_results, record_year_result, cached_results,
+                        save_results, stored_tables_json, run_progress,
+                        record_run_jobs, BACKGROUND_COLLECTOR)
 
 dropq_compute = DropqCompute()
 
@@ -51,7 +68,40 @@ tcversion_info = taxcalc._version.get_versions()
 
 taxcalc_version = ".".join([tcversion_info['version'], tcversion_info['full'][:6]])
 START_YEARS = ('2013', '2014', '2015', '2016', '2017')
-JOB_PROC_TIME_IN_SECONDS = 30
+# Seconds a request for the progress of a run is held waiting for a change,
+# short of the 30 seconds the router gives a request
+STATUS_WAIT_IN_SECONDS = float(os.environ.get('STATUS_WAIT', 25.0))
+# Seconds between the checks of a held request on the run in the database,
+# for changes no event was published about
+STATUS_RECHECK_IN_SECONDS = float(os.environ.get('STATUS_RECHECK', 5.0))
+# Most requests for the progress of runs held at once. Each takes up a
+# server thread, so keep this well below the number of threads
+STATUS_MAX_HELD = int(os.environ.get('STATUS_MAX_HELD', 4))
+_held_status_requests = threading.BoundedSemaphore(STATUS_MAX_HELD)
+# The results tables iter_csv writes out
+CSV_TABLE_IDS = ['fiscal_tots', 'mX_dec', 'mY_dec', 'df_dec', 'mX_bin',
+                 'mY_bin', 'df_bin']
+RESULTS_TOOLTIPS_JSON = json.dumps({
+    'diagnostic': DIAGNOSTIC_TOOLTIP,
+    'difference': DIFFERENCE_TOOLTIP,
+    'payroll': PAYROLL_TOOLTIP,
+    'income': INCOME_TOOLTIP,
+    'base': BASE_TOOLTIP,
+    'reform': REFORM_TOOLTIP,
+    'expanded': EXPANDED_TOOLTIP,
+    'adjusted': ADJUSTED_TOOLTIP,
+    'bins': INCOME_BINS_TOOLTIP,
+    'deciles': INCOME_DECILES_TOOLTIP
+})
+
+
+def tables_with_tooltips(tables_json):
+    """
+    Add the tooltips to serialized results tables, without deserializing
+    the tables again
+    """
+    return '{{"tooltips": {0}, {1}'.format(RESULTS_TOOLTIPS_JSON,
+                                           tables_json.lstrip()[1:])
 
 def benefit_surtax_fixup(mod):
     _ids = ['ID_BenefitSurtax_Switch_' + str(i) for i in range(7)]
@@ -87,17 +137,6 @@ def growth_fixup(mod):
     del mod['growth_choice']
 
 
-def denormalize(x):
-    ans = ["#".join([i[0],i[1]]) for i in x]
-    ans = [str(x) for x in ans]
-    return ans
-
-
-def normalize(x):
-    ans = [i.split('#') for i in x]
-    return ans
-
-
 def personal_results(request):
     """
     This view handles the input page and calls the function that
@@ -163,16 +202,24 @@ def personal_results(request):
                 # we don't have a real, public ip address for user
                 print "BEGIN DROPQ WORK FROM: unknown IP"
 
-            # start calc job
-            submitted_ids, max_q_length = dropq_compute.submit_dropq_calculation(worker_data, int(start_year))
-            if not submitted_ids:
+            # start calc job, unless an identical run was already computed
+            cache_key, cached = cached_results(worker_data, int(start_year),
+                                               'dropq')
+            if cached is not None:
+                submitted_ids, max_q_length = [], 0
+            else:
+                submitted_ids, max_q_length = dropq_compute.submit_dropq_calculation(worker_data, int(start_year))
+            if not submitted_ids and cached is None:
                 no_inputs = True
                 form_personal_exemp = personal_inputs
             else:
-                job_ids = denormalize(submitted_ids)
-                model.job_ids = job_ids
+                if submitted_ids:
+                    model.job_ids = denormalize(submitted_ids)
                 model.first_year = int(start_year)
+                model.result_cache_key = cache_key
                 model.save()
+                if cached is not None:
+                    save_results(model, cached)
                 unique_url = OutputUrl()
                 if request.user.is_authenticated():
                     current_user = User.objects.get(pk=request.user.id)
@@ -184,9 +231,13 @@ def personal_results(request):
 
                 unique_url.unique_inputs = model
                 unique_url.model_pk = model.pk
-                cur_dt = datetime.datetime.utcnow()
-                future_offset = datetime.timedelta(seconds=((2 + max_q_length) * JOB_PROC_TIME_IN_SECONDS))
-                expected_completion = cur_dt + future_offset
+                if cached is not None:
+                    expected_completion = datetime.datetime.utcnow()
+                else:
+                    record_run_jobs(model, submitted_ids)
+                    expected_completion = start_timing(model, 'dropq',
+                                                       submitted_ids,
+                                                       max_q_length)
                 unique_url.exp_comp_datetime = expected_completion
                 unique_url.save()
                 return redirect(unique_url)
@@ -203,7 +254,11 @@ def personal_results(request):
         # Probably a GET request, load a default form
         form_personal_exemp = PersonalExemptionForm(first_year=start_year)
 
-    taxcalc_default_params = default_policy(int(start_year))
+    # The default form's parameter sections only depend on the start year
+    # and taxcalc version, so they are served from the fragment cache. The
+    # defaults are only built if the sections have to be rendered
+    cache_params = not form_personal_exemp.is_bound
+    taxcalc_default_params = SimpleLazyObject(lambda: default_policy(int(start_year)))
 
     has_errors = False
     if has_field_errors(form_personal_exemp):
@@ -218,7 +273,9 @@ def personal_results(request):
         'taxcalc_version': taxcalc_version,
         'start_years': START_YEARS,
         'start_year': start_year,
-        'has_errors': has_errors
+        'has_errors': has_errors,
+        'cache_params': cache_params,
+        'fragment_cache_timeout': settings.FRAGMENT_CACHE_TIMEOUT
     }
 
 
@@ -237,12 +294,8 @@ def edit_personal_results(request, pk):
     except:
         raise Http404
 
-    model = TaxSaveInputs.objects.get(pk=url.model_pk)
+    model = TaxSaveInputs.objects.defer(*RUN_RESULT_FIELDS).get(pk=url.model_pk)
     start_year = model.first_year
-    #Get the user-input from the model in a way we can render
-    ser_model = serializers.serialize('json', [model])
-    user_inputs = json.loads(ser_model)
-    inputs = user_inputs[0]['fields']
 
     form_personal_exemp = PersonalExemptionForm(first_year=start_year, instance=model)
     taxcalc_default_params = default_policy(int(start_year))
@@ -272,32 +325,22 @@ def output_detail(request, pk):
     except:
         raise Http404
 
-    model = url.unique_inputs
+    # Only the status columns are read, the tables are loaded if the run
+    # has finished
+    model = (TaxSaveInputs.objects.only(*RUN_STATUS_FIELDS)
+             .get(pk=url.unique_inputs_id))
     if model.tax_result:
-        output = url.unique_inputs.tax_result
-        first_year = url.unique_inputs.first_year
-        created_on = url.unique_inputs.creation_date
-        tables = taxcalc_results_to_tables(output, first_year)
-        tables["tooltips"] = {
-            'diagnostic': DIAGNOSTIC_TOOLTIP,
-            'difference': DIFFERENCE_TOOLTIP,
-            'payroll': PAYROLL_TOOLTIP,
-            'income': INCOME_TOOLTIP,
-            'base': BASE_TOOLTIP,
-            'reform': REFORM_TOOLTIP,
-            'expanded': EXPANDED_TOOLTIP,
-            'adjusted': ADJUSTED_TOOLTIP,
-            'bins': INCOME_BINS_TOOLTIP,
-            'deciles': INCOME_DECILES_TOOLTIP
-        }
-        inputs = url.unique_inputs
+        first_year = model.first_year
+        created_on = model.creation_date
+        tables = tables_with_tooltips(stored_tables_json(model))
+        inputs = model
         is_registered = True if request.user.is_authenticated() else False
 
         context = {
             'locals':locals(),
             'unique_url':url,
             'taxcalc_version':taxcalc_version,
-            'tables': json.dumps(tables),
+            'tables': tables,
             'created_on': created_on,
             'first_year': first_year,
             'is_registered': is_registered,
@@ -307,73 +350,249 @@ def output_detail(request, pk):
         return render(request, 'taxbrain/results.html', context)
 
     else:
-
-        job_ids = model.job_ids
-        jobs_to_check = model.jobs_not_ready
-        if not jobs_to_check:
-            jobs_to_check = normalize(job_ids)
-        else:
-            jobs_to_check = normalize(jobs_to_check)
-
-        try:
-            jobs_ready = dropq_compute.dropq_results_ready(jobs_to_check)
-        except JobFailError as jfe:
-            print jfe
+        if model.job_failed:
             return render_to_response('taxbrain/failed.html')
 
-        if all(jobs_ready):
-            model.tax_result = dropq_compute.dropq_get_results(normalize(job_ids))
-            model.creation_date = datetime.datetime.now()
-            model.save()
-            return redirect(url)
+        # When the background collector is running it polls the workers and
+        # saves the results, so this view only has to read the database
+        if not BACKGROUND_COLLECTOR:
+            try:
+                if collect_results(model, dropq_compute):
+                    return redirect(url)
+            except JobFailError as jfe:
+                print jfe
+                return render_to_response('taxbrain/failed.html')
+
+        if request.method == 'POST':
+            # if not ready yet, insert number of minutes remaining
+            status = eta_status(url)
+            if status['eta'] > 0:
+                return JsonResponse(status, status=202)
+            else:
+                return JsonResponse(status, status=200)
+
         else:
-            jobs_not_ready = [sub_id for (sub_id, job_ready) in
-                                zip(jobs_to_check, jobs_ready) if not job_ready]
-            jobs_not_ready = denormalize(jobs_not_ready)
-            model.jobs_not_ready = jobs_not_ready
-            model.save()
-            if request.method == 'POST':
-                # if not ready yet, insert number of minutes remaining
-                exp_comp_dt = url.exp_comp_datetime
-                utc_now = datetime.datetime.utcnow()
-                utc_now = utc_now.replace(tzinfo=pytz.utc)
-                dt = exp_comp_dt - utc_now
-                exp_num_minutes = dt.total_seconds() / 60.
-                exp_num_minutes = round(exp_num_minutes, 2)
-                exp_num_minutes = exp_num_minutes if exp_num_minutes > 0 else 0
-                if exp_num_minutes > 0:
-                    return JsonResponse({'eta': exp_num_minutes}, status=202)
-                else:
-                    return JsonResponse({'eta': exp_num_minutes}, status=200)
+            print "rendering not ready yet"
+            status_url = reverse('output_status', kwargs={'pk': url.pk})
+            return render_to_response('taxbrain/not_ready.html',
+                                      {'eta': '100', 'status_url': status_url},
+                                      context_instance=RequestContext(request))
 
-            else:
-                print "rendering not ready yet"
-                return render_to_response('taxbrain/not_ready.html', {'eta': '100'}, context_instance=RequestContext(request))
 
+def eta_status(url):
+    """
+    The minutes left until the run of url is expected to be done, and the
+    seconds to wait before asking again
+    """
+    utc_now = datetime.datetime.utcnow()
+    utc_now = utc_now.replace(tzinfo=pytz.utc)
+    dt = url.exp_comp_datetime - utc_now
+    exp_num_minutes = dt.total_seconds() / 60.
+    exp_num_minutes = round(exp_num_minutes, 2)
+    exp_num_minutes = exp_num_minutes if exp_num_minutes > 0 else 0
+    return {'eta': exp_num_minutes,
+            'poll_interval': poll_interval(dt.total_seconds())}
 
-@permission_required('taxbrain.view_inputs')
-def csv_output(request, pk):
+
+def output_status(request, pk):
+    """
+    The progress of a run, as JSON: its state, 'running', 'done' or
+    'failed', the number of years done and the ETA, along with a token
+    for the state. A request passing the token of the state it last saw
+    as ?since= is held for up to STATUS_WAIT_IN_SECONDS, until the run
+    finishes a year, is done or fails. Events published by the collection
+    of the run's results end the wait. Without them, the run is read again
+    every STATUS_RECHECK_IN_SECONDS. The workers are asked about the run at
+    most once per request, and only when neither a background collector
+    nor the events of other processes report on it. When STATUS_MAX_HELD
+    requests are held already, the request is answered at once. The
+    poll_interval returned is 0 when the progress changed, so that the
+    client can wait for the next change straight away, and follows the
+    ETA otherwise
+    """
     try:
         url = OutputUrl.objects.get(pk=pk)
-    except:
+    except OutputUrl.DoesNotExist:
         raise Http404
 
-    # Create the HttpResponse object with the appropriate CSV header.
-    response = HttpResponse(content_type='text/csv')
+    since = request.GET.get('since')
+    deadline = time.time() + STATUS_WAIT_IN_SECONDS
+    channel = None
+    held = False
+    # Without a collector or events from other processes, callbacks and
+    # polls handled elsewhere are only found in the database, so the
+    # workers are asked once
+    ask_workers = not BACKGROUND_COLLECTOR and EVENT_BUS.redis is None
+    try:
+        while True:
+            model = (TaxSaveInputs.objects.only(*RUN_STATUS_FIELDS)
+                     .get(pk=url.unique_inputs_id))
+            if channel is None:
+                channel = run_channel(model)
+            # Listen before reading the progress, so that no change is missed
+            event = EVENT_BUS.listen(channel)
+            try:
+                progress = run_progress(model)
+                progress['token'] = "{state}:{years_done}".format(**progress)
+                left = deadline - time.time()
+                if (progress['state'] != 'running' or
+                        progress['token'] != since or left <= 0):
+                    break
+                if not held:
+                    held = _held_status_requests.acquire(False)
+                    if not held:
+                        break
+                if event.wait(min(left, STATUS_RECHECK_IN_SECONDS)):
+                    continue
+            finally:
+                EVENT_BUS.forget(channel, event)
+
+            # Nothing was published in a while, so ask the workers
+            if ask_workers:
+                ask_workers = False
+                try:
+                    collect_results(model, dropq_compute)
+                except JobFailError as jfe:
+                    print jfe
+    finally:
+        if held:
+            _held_status_requests.release()
+
+    progress.update(eta_status(url))
+    if progress['token'] != since:
+        progress['poll_interval'] = 0
+    return JsonResponse(progress)
+
+
+def dropq_finished(request):
+    """
+    This view is called back by a dropq worker when the job for a single
+    budget year is done. It saves that year's results, and the results of
+    the whole run once the last year is in.
+    """
+    job_id = request.GET.get('job_id', '')
+    status = request.GET.get('status')
+    max_length = RunJob._meta.get_field('job_id').max_length
+    if (not job_id or len(job_id) > max_length or '#' in job_id or
+            status not in ("SUCCESS", "FAILURE")):
+        return HttpResponseBadRequest("Give the job's id as ?job_id= and "
+                                      "?status=SUCCESS or ?status=FAILURE")
+    record_year_result(job_id, status, dropq_compute)
+    return HttpResponse('')
+
+
+class Echo(object):
+    """
+    A file-like object that hands back what is written to it, so that
+    csv.writer can format rows one at a time for a streaming response
+    """
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    """ Yield the CSV formatted lines of rows """
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def streaming_attachment(chunks, content_type, prefix, extension):
+    """ A streaming download of chunks, named after prefix and the time """
+    response = StreamingHttpResponse(chunks, content_type=content_type)
     now = datetime.datetime.now()
     suffix = "".join(map(str, [now.year, now.month, now.day, now.hour, now.minute,
                        now.second]))
-    filename = "taxbrain_outputs_" + suffix + ".csv"
+    filename = prefix + suffix + extension
     response['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+    return response
 
-    results = url.unique_inputs.tax_result
-    first_year = url.unique_inputs.first_year
-    csv_results = format_csv(results, pk, first_year)
-    writer = csv.writer(response)
-    for csv_row in csv_results:
-        writer.writerow(csv_row)
 
-    return response
+def csv_attachment(rows, prefix):
+    """ A streaming CSV download of rows """
+    return streaming_attachment(stream_csv(rows), 'text/csv', prefix, ".csv")
+
+
+def run_csv_rows(url_pks):
+    """
+    Yield the CSV rows of the results of the runs of url_pks, one after
+    another. Runs are loaded a batch at a time and runs without results
+    are left out
+    """
+    for start in range(0, len(url_pks), EXPORT_BATCH_SIZE):
+        batch = url_pks[start:start + EXPORT_BATCH_SIZE]
+        for pk, first_year, results in batch_results(batch):
+            for row in iter_csv(results, pk, first_year):
+                yield row
+
+
+@permission_required('taxbrain.view_inputs')
+def csv_output(request, pk):
+    try:
+        url = OutputUrl.objects.get(pk=pk)
+    except:
+        raise Http404
+
+    model = (TaxSaveInputs.objects.only('tax_result', 'first_year')
+             .get(pk=url.unique_inputs_id))
+    results = load_tax_result(model, CSV_TABLE_IDS)
+    csv_results = iter_csv(results, pk, model.first_year)
+    return csv_attachment(csv_results, "taxbrain_outputs_")
+
+
+def requested_url_pks(request):
+    """
+    The OutputUrl pks of the runs to export, given either as a comma
+    separated list, ?pks=12,15,17, or as an inclusive range,
+    ?start=12&end=40. At most EXPORT_MAX_RUNS runs are exported. Returns
+    None if the parameters are missing or malformed, or ask for more
+    """
+    try:
+        if 'pks' in request.GET:
+            url_pks = [int(pk) for pk in request.GET['pks'].split(',')]
+        else:
+            start, end = int(request.GET['start']), int(request.GET['end'])
+            url_pks = list(OutputUrl.objects.filter(pk__range=(start, end))
+                           .order_by('pk').values_list('pk', flat=True)
+                           [:EXPORT_MAX_RUNS + 1])
+    except (KeyError, ValueError):
+        return None
+    if len(url_pks) > EXPORT_MAX_RUNS:
+        return None
+    return url_pks
+
+
+def bad_export_request():
+    return HttpResponseBadRequest("Give the runs to export as ?pks=12,15,17 "
+                                  "or ?start=12&end=40, at most {0} of them"
+                                  .format(EXPORT_MAX_RUNS))
+
+
+@permission_required('taxbrain.view_inputs')
+def csv_outputs(request):
+    """
+    The results of several runs in one CSV file, streamed run by run, e.g.
+    /taxbrain/outputs.csv/?pks=12,15,17
+    """
+    url_pks = requested_url_pks(request)
+    if url_pks is None:
+        return bad_export_request()
+    return csv_attachment(run_csv_rows(url_pks), "taxbrain_outputs_")
+
+
+@permission_required('taxbrain.view_inputs')
+def outputs_archive(request):
+    """
+    The results of many runs as a tar archive of CSV tables with a run_id
+    column, streamed a batch of runs at a time, e.g.
+    /taxbrain/outputs.tar/?start=12&end=400. The archive itself is left
+    uncompressed, GZipMiddleware compresses it on the way out
+    """
+    url_pks = requested_url_pks(request)
+    if url_pks is None:
+        return bad_export_request()
+    return streaming_attachment(archive_chunks(url_pks), 'application/x-tar',
+                                "taxbrain_outputs_", ".tar")
 
 @permission_required('taxbrain.view_inputs')
 def csv_input(request, pk):
@@ -389,7 +608,8 @@ def csv_input(request, pk):
         """
         return x not in ['outputurl', 'id', 'inflation', 'inflation_years',
                          'medical_inflation', 'medical_years', 'tax_result',
-                         'creation_date']
+                         'creation_date', 'job_failed', 'result_cache_key',
+                         'tables_json']
 
     field_names = [f.name for f in TaxSaveInputs._meta.get_fields(include_parents=False)]
     field_names = tuple(filter(filter_names, field_names))
@@ -402,7 +622,8 @@ def csv_input(request, pk):
     filename = "taxbrain_inputs_" + suffix + ".csv"
     response['Content-Disposition'] = 'attachment; filename="' + filename + '"'
 
-    inputs = url.unique_inputs
+    inputs = (TaxSaveInputs.objects.defer(*RUN_RESULT_FIELDS)
+              .get(pk=url.unique_inputs_id))
 
     writer = csv.writer(response)
     writer.writerow(field_names)
@@ -413,9 +634,41 @@ def csv_input(request, pk):
 @permission_required('taxbrain.view_inputs')
 def pdf_view(request):
     """
-    This view creates the pdfs.
+    This view creates the pdfs of the results page it is linked from, or
+    given as ?page=. The pdfs are made from the run's results tables, see
+    pdf.report_pdf. Until a pdf is ready, a page that reloads this view
+    for it is served instead
     """
-    pdf = pdfkit.from_url(request.META['HTTP_REFERER'], False)
+    try:
+        page = (request.GET.get('page') or
+                urlparse(request.META['HTTP_REFERER']).path)
+        match = resolve(page)
+        report = run_report(match.url_name, match.kwargs.get('pk'))
+    except (KeyError, Http404):
+        raise Http404
+    if report is None:
+        raise Http404
+
+    try:
+        pdf = report_pdf(*report)
+    except ObjectDoesNotExist:
+        raise Http404
+    except PdfRenderFailed:
+        return HttpResponse("The report could not be made", status=500)
+    except PdfQueueFull:
+        response = HttpResponse("Too many reports are being made, please "
+                                "try again in a minute", status=503)
+        response['Retry-After'] = '60'
+        return response
+    if pdf is None:
+        retry_url = "{0}?{1}".format(request.path, urlencode({'page': page}))
+        response = render(request, 'taxbrain/pdf_not_ready.html',
+                          {'retry_url': retry_url}, status=202)
+        response['Refresh'] = "{0}; url={1}".format(PDF_RETRY_IN_SECONDS,
+                                                    retry_url)
+        response['Retry-After'] = str(PDF_RETRY_IN_SECONDS)
+        return response
+
     response = HttpResponse(pdf, content_type='application/pdf')
     response['Content-Disposition'] = 'attachment; filename="tax_results.pdf"'
 
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 import os
+import tempfile
 
 SECRET_KEY = os.environ.get('SECRET_KEY', '')
 
@@ -114,6 +115,39 @@ else:
       }
   }
 
+# Caches
+# The rendered parameter sections of the input forms go in their own
+# cache, kept in local memory, or on disk if FRAGMENT_CACHE_DIR is set
+FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('FRAGMENT_CACHE_TIMEOUT', 3600))
+FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR', '')
+# The PDF reports of the results pages go in a cache of their own too,
+# kept on disk so that every process serves the reports any of them made
+PDF_CACHE_TIMEOUT = int(os.environ.get('PDF_CACHE_TIMEOUT', 7 * 24 * 3600))
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR',
+                               os.path.join(tempfile.gettempdir(),
+                                            'taxbrain_pdfs'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fragments',
+        'TIMEOUT': FRAGMENT_CACHE_TIMEOUT,
+    },
+    'pdfs': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': PDF_CACHE_DIR,
+        'TIMEOUT': PDF_CACHE_TIMEOUT,
+    },
+}
+if FRAGMENT_CACHE_DIR:
+    CACHES['fragments'].update({
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': FRAGMENT_CACHE_DIR,
+    })
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
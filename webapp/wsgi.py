@@ -5,3 +5,7 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webapp.settings")
 
 from dj_static import Cling
 application = Cling(get_wsgi_application())
+
+# Only the web process probes the worker hosts in the background
+from webapp.apps.taxbrain.compute import HOST_HEALTH
+HOST_HEALTH.start()